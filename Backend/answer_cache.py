@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from config import ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_MAX_ENTRIES
+
+# Cache of generated answers for /chat. An entry is found again when the retrieved
+# chunks are exactly the same and the embedding of the standalone question is at
+# least `threshold` cosine-similar to the cached one. Entries are dropped when any
+# file that contributed a chunk is re-ingested or deleted.
+
+
+class AnswerCache:
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # chunk id set -> OrderedDict of question -> entry, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, question_vector, chunk_ids):
+        key = frozenset(chunk_ids)
+        vector = self._normalize(question_vector)
+        with self._lock:
+            candidates = self._entries.get(key)
+            if candidates:
+                questions = list(candidates)
+                matrix = np.stack([candidates[question]["vector"] for question in questions])
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return candidates[questions[best]]["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, question, question_vector, chunk_ids, sources, answer):
+        key = frozenset(chunk_ids)
+        with self._lock:
+            candidates = self._entries.setdefault(key, OrderedDict())
+            if question not in candidates:
+                self._size += 1
+            candidates[question] = {
+                "vector": self._normalize(question_vector),
+                "sources": set(sources),
+                "answer": answer,
+            }
+            self._entries.move_to_end(key)
+            while self._size > self.max_entries and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def invalidate_sources(self, sources):
+        sources = set(sources)
+        with self._lock:
+            for key in list(self._entries):
+                candidates = self._entries[key]
+                for question in [q for q, entry in candidates.items() if entry["sources"] & sources]:
+                    del candidates[question]
+                    self._size -= 1
+                    self.invalidations += 1
+                if not candidates:
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "threshold": self.threshold,
+            }
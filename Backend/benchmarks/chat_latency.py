@@ -0,0 +1,50 @@
+import time
+import argparse
+import statistics
+import httpx
+
+# Measures /chat time to first token and total time against a running server, for
+# the first turn of new sessions and for follow-up turns. Run it before and after a
+# change to compare.
+
+
+def timed_chat(client, base_url, session_id, query):
+    start = time.perf_counter()
+    first_token = None
+    with client.stream("POST", f"{base_url}/chat", json={"query": query, "session_id": session_id}) as response:
+        response.raise_for_status()
+        for chunk in response.iter_text():
+            if chunk and first_token is None:
+                first_token = time.perf_counter() - start
+    total = time.perf_counter() - start
+    return first_token if first_token is not None else total, total
+
+
+def summarize(label, timings):
+    first_tokens = [first for first, _ in timings]
+    totals = [total for _, total in timings]
+    print(
+        f"{label}: time to first token median {statistics.median(first_tokens):.3f}s "
+        f"max {max(first_tokens):.3f}s, total median {statistics.median(totals):.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure /chat latency")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--sessions", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=3, help="Turns per session, the first one has no history")
+    parser.add_argument("--query", default="What information do the uploaded files contain?")
+    args = parser.parse_args()
+
+    first_turns, follow_ups = [], []
+    with httpx.Client(timeout=None) as client:
+        for _ in range(args.sessions):
+            session_id = client.post(f"{args.base_url}/create_chat_session").json()["session_id"]
+            for turn in range(args.turns):
+                timing = timed_chat(client, args.base_url, session_id, f"{args.query} ({turn})")
+                (first_turns if turn == 0 else follow_ups).append(timing)
+
+    summarize("first turn", first_turns)
+    if follow_ups:
+        summarize("follow-up turns", follow_ups)
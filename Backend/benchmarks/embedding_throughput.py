@@ -0,0 +1,50 @@
+import os
+import sys
+import uuid
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["ANONYMIZED_TELEMETRY"] = "False"
+
+from langchain_chroma import Chroma
+from langchain_community.embeddings import OllamaEmbeddings
+from langchain_core.documents import Document
+from embedding_pipeline import embed_and_store
+from benchmarks.fake_ollama import start_fake_ollama
+
+# Measures the batched embedding stage against the fake Ollama server, for a range
+# of concurrency settings, writing into an in-memory Chroma collection.
+
+
+def run(chunks, batch_size, concurrency, embed_latency, fail_rate, dim):
+    server, url = start_fake_ollama(dim=dim, embed_latency=embed_latency, fail_rate=fail_rate)
+    try:
+        embeddings = OllamaEmbeddings(base_url=url, model="fake-embed")
+        db = Chroma(collection_name=f"bench_{uuid.uuid4().hex}", embedding_function=embeddings)
+        documents = [
+            Document(page_content=f"Synthetic chunk {i} " + "lorem ipsum " * 40, metadata={"source": "bench.txt"})
+            for i in range(chunks)
+        ]
+        ids = [str(uuid.uuid4()) for _ in documents]
+        result = embed_and_store(
+            db, embeddings, documents, ids, batch_size=batch_size, concurrency=concurrency, retry_backoff=0.05
+        )
+        result["stored"] = db._collection.count()
+        return result
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the embedding stage of ingestion")
+    parser.add_argument("--chunks", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--embed-latency", type=float, default=0.005, help="Seconds per embedded text")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--dim", type=int, default=1024)
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        result = run(args.chunks, args.batch_size, concurrency, args.embed_latency, args.fail_rate, args.dim)
+        print(f"concurrency={concurrency}: {result['chunks_per_second']:.1f} chunks/s, stored {result['stored']}")
@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import shutil
+import tempfile
+import subprocess
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_ollama import start_fake_ollama
+from benchmarks.startup_time import free_port, wait_for
+from benchmarks.synthetic_corpus import generate_corpus
+
+# End-to-end benchmark without GPUs: generates a synthetic corpus (see
+# synthetic_corpus.py), starts a fake Ollama (see fake_ollama.py) and measures
+#
+#   - ingestion: `update_vector_store` on the empty index, then a rescan of the
+#     unchanged files
+#   - chat: /chat time to first token and tokens per second with N concurrent
+#     sessions, against a uvicorn server on the index built above
+#   - sessions: /chat_sessions latency with many sessions stored
+#
+# Results are written as JSON to --output. Pass --compare with an earlier result file
+# to print the change of every metric. The corpus, databases and server log live in a
+# temporary work directory that is removed afterwards unless --keep is passed.
+#
+# Tokens are counted as the words of a streamed answer, which is what the fake
+# Ollama streams per token. The answer cache is off unless --answer-cache is passed,
+# so every question goes through the LLM.
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def distribution(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": max(values) if values else None,
+    }
+
+
+def measure_ingestion(files_dir):
+    # Runs in this process, the environment is already set up for the benchmark
+    import ingestion
+
+    size = sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(files_dir) for name in names
+    )
+    start = time.perf_counter()
+    summary = ingestion.update_vector_store()
+    seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ingestion.update_vector_store()
+    rescan_seconds = time.perf_counter() - start
+
+    return {
+        "files": summary["files"],
+        "megabytes": size / 1e6,
+        "chunks": summary["chunks"],
+        "embedded": summary["embedded"],
+        "failed": len(summary["failed"]),
+        "seconds": seconds,
+        "files_per_second": summary["files"] / seconds,
+        "chunks_per_second": summary["chunks"] / seconds,
+        "rescan_seconds": rescan_seconds,
+    }
+
+
+async def timed_chat(client, base_url, session_id, query):
+    start = time.perf_counter()
+    first_token = None
+    chunks = []
+    async with client.stream("POST", f"{base_url}/chat", json={"query": query, "session_id": session_id}) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_text():
+            if chunk and first_token is None:
+                first_token = time.perf_counter() - start
+            chunks.append(chunk)
+    total = time.perf_counter() - start
+    tokens = len("".join(chunks).split())
+    if first_token is None:
+        first_token = total
+    # Streaming rate after the first token
+    rate = (tokens - 1) / (total - first_token) if tokens > 1 and total > first_token else None
+    return {"first_token": first_token, "total": total, "tokens": tokens, "tokens_per_second": rate}
+
+
+async def run_session(client, base_url, number, turns, results, errors):
+    response = await client.post(f"{base_url}/create_chat_session")
+    session_id = response.json()["session_id"]
+    for turn in range(turns):
+        # Distinct questions, so sessions do not share cached work
+        query = f"What does the report say about the products in section {turn + 1}? (session {number})"
+        try:
+            results.append(await timed_chat(client, base_url, session_id, query))
+        except httpx.HTTPError as e:
+            errors.append(str(e))
+
+
+async def measure_chat(base_url, concurrency, turns):
+    results, errors = [], []
+    limits = httpx.Limits(max_connections=concurrency + 10, max_keepalive_connections=concurrency + 10)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            run_session(client, base_url, number, turns, results, errors) for number in range(concurrency)
+        ))
+        wall = time.perf_counter() - start
+
+    rates = [result["tokens_per_second"] for result in results if result["tokens_per_second"] is not None]
+    tokens = sum(result["tokens"] for result in results)
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(errors),
+        "seconds": wall,
+        "requests_per_second": len(results) / wall,
+        "first_token_seconds": distribution([result["first_token"] for result in results]),
+        "total_seconds": distribution([result["total"] for result in results]),
+        "stream_tokens_per_second": distribution(rates),
+        "aggregate_tokens_per_second": tokens / wall,
+    }
+
+
+async def measure_session_listing(base_url, sessions, requests, page_size):
+    async with httpx.AsyncClient(timeout=None) as client:
+        existing = len((await client.get(f"{base_url}/chat_sessions")).json())
+        semaphore = asyncio.Semaphore(32)
+
+        async def create():
+            async with semaphore:
+                (await client.post(f"{base_url}/create_chat_session")).raise_for_status()
+
+        await asyncio.gather(*(create() for _ in range(max(0, sessions - existing))))
+
+        results = {"sessions": max(sessions, existing)}
+        for label, params in (("all", {}), ("page", {"limit": page_size})):
+            timings = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                (await client.get(f"{base_url}/chat_sessions", params=params)).raise_for_status()
+                timings.append(time.perf_counter() - start)
+            results[f"{label}_seconds"] = distribution(timings)
+        results["page_size"] = page_size
+        return results
+
+
+def flatten(results, prefix=""):
+    # Numeric leaves by dotted path, lists of runs are keyed by their concurrency
+    values = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            values.update(flatten(value, f"{prefix}{key}."))
+    elif isinstance(results, list):
+        for item in results:
+            label = item.get("concurrency", results.index(item)) if isinstance(item, dict) else results.index(item)
+            values.update(flatten(item, f"{prefix}{label}."))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        values[prefix.rstrip(".")] = results
+    return values
+
+
+def compare(baseline, current):
+    baseline_values = flatten({key: baseline.get(key) for key in ("ingestion", "chat", "sessions")})
+    current_values = flatten({key: current.get(key) for key in ("ingestion", "chat", "sessions")})
+    for key, value in current_values.items():
+        before = baseline_values.get(key)
+        if before is None:
+            continue
+        change = f"{(value - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{key}: {before:.4g} -> {value:.4g} ({change})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against a fake Ollama")
+    parser.add_argument("--pdfs", type=int, default=10)
+    parser.add_argument("--pages", type=int, default=5, help="Pages per PDF")
+    parser.add_argument("--csvs", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=200, help="Rows per CSV file")
+    parser.add_argument("--jsons", type=int, default=10)
+    parser.add_argument("--records", type=int, default=100, help="Records per JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dim", type=int, default=768, help="Embedding dimension")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="Seconds per embedded text")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="Seconds between streamed tokens")
+    parser.add_argument("--answer-tokens", type=int, default=64, help="Tokens per LLM reply")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrent chat sessions")
+    parser.add_argument("--turns", type=int, default=3, help="Questions per chat session")
+    parser.add_argument("--sessions", type=int, default=1000, help="Stored sessions when listing /chat_sessions")
+    parser.add_argument("--listing-requests", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--answer-cache", action="store_true", help="Keep the answer cache enabled")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output", required=True, help="Result file to write")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory")
+    parser.add_argument("--compare", help="Earlier result file to compare with")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="e2e-bench-")
+    try:
+        files_dir = os.path.join(work_dir, "files")
+        generate_corpus(files_dir, args.pdfs, args.pages, args.csvs, args.rows, args.jsons, args.records, args.seed)
+
+        fake_server, ollama_url = start_fake_ollama(
+            dim=args.dim, embed_latency=args.embed_latency, token_delay=args.token_delay, answer_tokens=args.answer_tokens
+        )
+        os.environ.update(
+            OLLAMA_BASE_URL=ollama_url,
+            FILES_DIR=files_dir,
+            DB_DIR=os.path.join(work_dir, "db"),
+            CHAT_SESSIONS_DIR=os.path.join(work_dir, "chat_sessions"),
+            JOBS_DIR=os.path.join(work_dir, "jobs"),
+            EMBEDDING_CACHE_DIR=os.path.join(work_dir, "embedding_cache"),
+            ANSWER_CACHE_ENABLED="true" if args.answer_cache else "false",
+            ANONYMIZED_TELEMETRY="False",
+        )
+
+        results = {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "options": vars(args),
+        }
+        results["ingestion"] = measure_ingestion(files_dir)
+        print(f"ingestion: {json.dumps(results['ingestion'])}")
+
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        server_log = os.path.join(work_dir, "server.log")
+        with open(server_log, "w") as log:
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "chatbot:app", "--host", "127.0.0.1", "--port", str(port),
+                 "--workers", str(args.workers)],
+                cwd=BACKEND_DIR, env=os.environ, stdout=log, stderr=subprocess.STDOUT,
+            )
+        try:
+            with httpx.Client(timeout=5) as client:
+                wait_for(
+                    client, f"{base_url}/readyz",
+                    lambda r: r.status_code == 200
+                    and r.json().get("reconcile_status") in (None, "completed", "failed", "cancelled"),
+                    args.timeout,
+                )
+            results["chat"] = []
+            for concurrency in args.concurrency:
+                run = asyncio.run(measure_chat(base_url, concurrency, args.turns))
+                results["chat"].append(run)
+                print(
+                    f"chat, {concurrency} concurrent: first token p50 {run['first_token_seconds']['p50']:.3f}s "
+                    f"p95 {run['first_token_seconds']['p95']:.3f}s, "
+                    f"{run['aggregate_tokens_per_second']:.1f} tokens/s, {run['errors']} errors"
+                )
+            results["sessions"] = asyncio.run(
+                measure_session_listing(base_url, args.sessions, args.listing_requests, args.page_size)
+            )
+            print(f"sessions: {json.dumps(results['sessions'])}")
+        finally:
+            server.terminate()
+            server.wait()
+            fake_server.shutdown()
+
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Wrote {args.output}")
+    finally:
+        if args.keep:
+            print(f"Kept the work directory {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
@@ -0,0 +1,166 @@
+import json
+import time
+import math
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal stand-in for the Ollama HTTP API, so ingestion and chat can be exercised
+# and measured without a GPU. Embeddings are deterministic: the same text always maps
+# to the same unit vector. Chat and generate replies are `answer_tokens` words picked
+# by a hash of the prompt, streamed one word per line every `token_delay` seconds.
+
+WORDS = [
+    "the", "answer", "is", "based", "on", "documents", "price", "item", "table", "report", "shows", "total",
+    "value", "of", "and", "in", "for", "a", "file", "section", "page", "data", "record", "listed",
+]
+
+
+def fake_embedding(text, dim):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def fake_reply(prompt, tokens):
+    seed = int.from_bytes(hashlib.sha256(prompt.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    return [rng.choice(WORDS) + " " for _ in range(tokens)]
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    # Set on the server instance by `start_fake_ollama`
+    options = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, payload, content_key):
+        # Newline-delimited JSON like Ollama: one object per token, then a final one
+        # with `done` and the token counts. Without streaming only the final object.
+        options = self.server.options
+        if content_key == "message":
+            prompt = "\n".join(str(message.get("content", "")) for message in payload.get("messages", []))
+        else:
+            prompt = payload.get("prompt", "")
+        tokens = fake_reply(prompt, options["answer_tokens"])
+        base = {"model": payload.get("model", ""), "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        start = time.perf_counter()
+
+        def chunk(text, done):
+            content = {"role": "assistant", "content": text} if content_key == "message" else text
+            return {**base, content_key: content, "done": done}
+
+        if not payload.get("stream", True):
+            time.sleep(options["token_delay"] * len(tokens))
+            self._send_json({**chunk("".join(tokens), True), "done_reason": "stop", "eval_count": len(tokens)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            for token in tokens:
+                time.sleep(options["token_delay"])
+                self.wfile.write((json.dumps(chunk(token, False)) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            final = {
+                **chunk("", True),
+                "done_reason": "stop",
+                "prompt_eval_count": len(prompt.split()),
+                "eval_count": len(tokens),
+                "eval_duration": int((time.perf_counter() - start) * 1e9),
+            }
+            self.wfile.write((json.dumps(final) + "\n").encode("utf-8"))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading, e.g. a cancelled request
+            pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _should_fail(self):
+        options = self.server.options
+        with self.server.lock:
+            self.server.requests += 1
+            return options["fail_rate"] > 0 and self.server.rng.random() < options["fail_rate"]
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": []})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        options = self.server.options
+        payload = self._read_json()
+        if self._should_fail():
+            self._send_json({"error": "injected failure"}, status=500)
+            return
+
+        if self.path == "/api/embeddings":
+            time.sleep(options["embed_latency"])
+            self._send_json({"embedding": fake_embedding(payload.get("prompt", ""), options["dim"])})
+        elif self.path == "/api/embed":
+            texts = payload.get("input", [])
+            if isinstance(texts, str):
+                texts = [texts]
+            time.sleep(options["embed_latency"] * max(1, len(texts)))
+            self._send_json({"embeddings": [fake_embedding(text, options["dim"]) for text in texts]})
+        elif self.path == "/api/chat":
+            self._stream(payload, "message")
+        elif self.path == "/api/generate":
+            self._stream(payload, "response")
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+
+def start_fake_ollama(host="127.0.0.1", port=0, dim=1024, embed_latency=0.0, fail_rate=0.0, seed=0,
+                      token_delay=0.0, answer_tokens=32):
+    # Runs the server on a daemon thread and returns it together with its base URL
+    server = ThreadingHTTPServer((host, port), FakeOllamaHandler)
+    server.daemon_threads = True
+    server.options = {
+        "dim": dim, "embed_latency": embed_latency, "fail_rate": fail_rate,
+        "token_delay": token_delay, "answer_tokens": answer_tokens,
+    }
+    server.lock = threading.Lock()
+    server.rng = random.Random(seed)
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, name="fake-ollama", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake Ollama server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--dim", type=int, default=1024, help="Embedding dimension")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="Seconds per embedded text")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="Seconds between streamed tokens")
+    parser.add_argument("--answer-tokens", type=int, default=32, help="Tokens per chat or generate reply")
+    args = parser.parse_args()
+
+    server, url = start_fake_ollama(
+        args.host, args.port, args.dim, args.embed_latency, args.fail_rate,
+        token_delay=args.token_delay, answer_tokens=args.answer_tokens,
+    )
+    print(f"Fake Ollama listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["ANONYMIZED_TELEMETRY"] = "False"
+# The keyword index lives in the manifest database, keep the benchmark's apart
+os.environ["DB_DIR"] = tempfile.mkdtemp(prefix="retrieval-bench-")
+
+from langchain_chroma import Chroma
+from langchain_community.embeddings import OllamaEmbeddings
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+import sparse_index
+import vector_index as vector_store
+from embedding_pipeline import embed_and_store
+from manifest import open_manifest, set_file, chunk_hash
+from retrieval import hybrid_search, mmr_search, vector_index
+
+# Compares recall@k and latency of the Chroma MMR retriever, MMR on the NumPy vector
+# index and hybrid BM25 + vector retrieval on a synthetic product table, one chunk per
+# row like the CSV loader makes. Identifier questions ask for a SKU, name questions for
+# a product's name.
+#
+# Without --ollama-url the embeddings are hashed character trigrams: fast and
+# deterministic, but only a rough stand-in for a real embedding model. Pass the URL of
+# an Ollama server to measure with the model used in production.
+
+ADJECTIVES = ["red", "compact", "wireless", "steel", "organic", "smart", "vintage", "heavy", "foldable", "silent"]
+NOUNS = ["kettle", "lamp", "drill", "backpack", "router", "chair", "blender", "monitor", "tent", "speaker"]
+CATEGORIES = ["kitchen", "outdoor", "office", "tools", "electronics"]
+
+
+class TrigramEmbeddings(Embeddings):
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = [0.0] * self.dim
+        padded = f"  {text.lower()} "
+        for i in range(len(padded) - 2):
+            digest = hashlib.md5(padded[i:i + 3].encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "big") % self.dim] += 1.0
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def build_corpus(rows, seed):
+    rng = random.Random(seed)
+    documents, questions = [], []
+    for i in range(rows):
+        sku = f"SKU{rng.randint(10, 99)}-{i:05d}"
+        name = f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {rng.choice(['mini', 'pro', 'max', 'lite'])} {i}"
+        text = (
+            f"sku: {sku}\nname: {name}\ncategory: {rng.choice(CATEGORIES)}\n"
+            f"price: {rng.randint(5, 500)}.{rng.randint(0, 99):02d}\nstock: {rng.randint(0, 1000)}"
+        )
+        documents.append(Document(page_content=text, metadata={"source": "products.csv", "chunk_id": chunk_hash(text)}))
+        questions.append(("identifier", f"What is the price of {sku}?", chunk_hash(text)))
+        questions.append(("name", f"How many {name} are in stock?", chunk_hash(text)))
+    return documents, questions
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(rows, queries, k, fetch_k, candidates, embeddings, seed):
+    documents, questions = build_corpus(rows, seed)
+    ids = [doc.metadata["chunk_id"] for doc in documents]
+    db = Chroma(collection_name=f"bench_{uuid.uuid4().hex}", embedding_function=embeddings)
+    vectors = {}
+    embed_and_store(db, embeddings, documents, ids, on_batch=lambda batch_ids, batch: vectors.update(zip(batch_ids, batch)))
+
+    conn = open_manifest()
+    with conn:
+        set_file(conn, "products.csv", {"size": 0, "mtime": 0, "sha256": ""}, ids)
+        sparse_index.add_chunks(conn, [(doc.metadata["chunk_id"], doc.page_content) for doc in documents])
+        vector_store.store_vectors(conn, list(vectors.items()))
+    vector_index.load(conn)
+
+    sample = random.Random(seed).sample(questions, min(queries, len(questions)))
+    vectors = embeddings.embed_documents([question for _, question, _ in sample])
+    retrievers = {
+        "chroma-mmr": lambda question, vector: db.max_marginal_relevance_search_by_vector(
+            vector, k=k, fetch_k=fetch_k, lambda_mult=0.7
+        ),
+        "mmr": lambda question, vector: mmr_search(db, vector, k=k, fetch_k=fetch_k, lambda_mult=0.7),
+        "hybrid": lambda question, vector: hybrid_search(db, question, vector, k=k, candidates=candidates),
+    }
+
+    results = {}
+    for name, retrieve in retrievers.items():
+        for (kind, question, target), vector in zip(sample, vectors):
+            start = time.perf_counter()
+            found = retrieve(question, vector)
+            elapsed = time.perf_counter() - start
+            hit = target in {doc.metadata.get("chunk_id") for doc in found}
+            for group in (kind, "all"):
+                hits, timings = results.setdefault((name, group), ([], []))
+                hits.append(hit)
+                timings.append(elapsed)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare MMR and hybrid retrieval on recall@k and latency")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--fetch-k", type=int, default=30, help="MMR candidates")
+    parser.add_argument("--candidates", type=int, default=20, help="Hybrid candidates per retriever")
+    parser.add_argument("--ollama-url", help="Embed with this Ollama server instead of hashed trigrams")
+    parser.add_argument("--model", default="mxbai-embed-large")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.ollama_url:
+        embeddings = OllamaEmbeddings(base_url=args.ollama_url, model=args.model)
+    else:
+        embeddings = TrigramEmbeddings()
+
+    results = run(args.rows, args.queries, args.k, args.fetch_k, args.candidates, embeddings, args.seed)
+    for (name, group), (hits, timings) in sorted(results.items()):
+        print(
+            f"{name:>10} {group:>10}: recall@{args.k} {sum(hits) / len(hits):.3f}, "
+            f"latency mean {statistics.mean(timings) * 1000:.1f}ms p95 {percentile(timings, 0.95) * 1000:.1f}ms "
+            f"({len(hits)} queries)"
+        )
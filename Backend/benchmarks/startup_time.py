@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import argparse
+import subprocess
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_ollama import start_fake_ollama
+
+# Measures how long the server takes to start: until /healthz answers (the process
+# serves requests), until /readyz reports ready (the vector store is open) and until
+# the startup reconciliation job has finished. The first run starts from an empty
+# index, later runs restart on the index the first one built, like a uvicorn reload.
+#
+# The server runs against a fake Ollama, see fake_ollama.py. Without --files-dir a
+# directory of small CSV files is generated.
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def generate_files(directory, count, rows):
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(directory, f"table_{i:04d}.csv"), "w") as file:
+            file.write("id,name,price\n")
+            file.writelines(f"{i}-{j},item {j} of file {i},{j * 1.5:.2f}\n" for j in range(rows))
+
+
+def wait_for(client, url, condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = client.get(url)
+            if condition(response):
+                return response
+        except httpx.TransportError:
+            pass
+        time.sleep(0.02)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def measure_startup(env, timeout):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "chatbot:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=backend_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(timeout=5) as client:
+            wait_for(client, f"{base_url}/healthz", lambda r: r.status_code == 200, timeout)
+            live = time.perf_counter() - start
+            wait_for(client, f"{base_url}/readyz", lambda r: r.status_code == 200, timeout)
+            ready = time.perf_counter() - start
+            wait_for(
+                client, f"{base_url}/readyz",
+                lambda r: r.json().get("reconcile_status") in (None, "completed", "failed", "cancelled"), timeout,
+            )
+            reconciled = time.perf_counter() - start
+        return live, ready, reconciled
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure server startup time")
+    parser.add_argument("--files-dir", help="Files to index (default: generated CSV files)")
+    parser.add_argument("--files", type=int, default=50, help="Number of generated CSV files")
+    parser.add_argument("--rows", type=int, default=200, help="Rows per generated CSV file")
+    parser.add_argument("--runs", type=int, default=3, help="Server starts, the first one on an empty index")
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="startup-bench-")
+    files_dir = args.files_dir or os.path.join(work_dir, "files")
+    if not args.files_dir:
+        generate_files(files_dir, args.files, args.rows)
+
+    fake_server, ollama_url = start_fake_ollama(dim=256)
+    env = dict(
+        os.environ,
+        OLLAMA_BASE_URL=ollama_url,
+        FILES_DIR=os.path.abspath(files_dir),
+        DB_DIR=os.path.join(work_dir, "db"),
+        CHAT_SESSIONS_DIR=os.path.join(work_dir, "chat_sessions"),
+        JOBS_DIR=os.path.join(work_dir, "jobs"),
+        EMBEDDING_CACHE_DIR=os.path.join(work_dir, "embedding_cache"),
+        ANONYMIZED_TELEMETRY="False",
+    )
+
+    for run in range(args.runs):
+        live, ready, reconciled = measure_startup(env, args.timeout)
+        label = "empty index" if run == 0 else "existing index"
+        print(f"run {run + 1} ({label}): live {live:.2f}s, ready {ready:.2f}s, reconciled {reconciled:.2f}s")
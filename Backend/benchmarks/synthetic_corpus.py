@@ -0,0 +1,162 @@
+import os
+import csv
+import json
+import random
+import argparse
+
+# Synthetic documents for the benchmarks: PDFs of prose, CSV product tables and JSON
+# record lists, the file types ingestion handles without a model. The same seed
+# always generates the same files. The PDFs are written by hand (one Helvetica text
+# stream per page) so no PDF library is needed, and pypdf extracts their text.
+
+ADJECTIVES = ["red", "compact", "wireless", "steel", "organic", "smart", "vintage", "heavy", "foldable", "silent"]
+NOUNS = ["kettle", "lamp", "drill", "backpack", "router", "chair", "blender", "monitor", "tent", "speaker"]
+CATEGORIES = ["kitchen", "outdoor", "office", "tools", "electronics"]
+REGIONS = ["north", "south", "east", "west", "central"]
+SENTENCES = [
+    "Quarterly sales of the {product} grew in the {region} region.",
+    "The {product} is stocked in the {category} aisle of every store.",
+    "Customers rated the {product} highly for its build quality.",
+    "Returns of the {product} fell after the packaging was redesigned.",
+    "Supplier delays affected deliveries of the {product} to the {region} warehouse.",
+    "The {category} team plans a promotion for the {product} next month.",
+    "Inventory of the {product} is reviewed every week by the {region} office.",
+]
+
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+LINES_PER_PAGE = 48
+LINE_WIDTH = 90
+
+
+def product_name(rng):
+    return f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}"
+
+
+def paragraph(rng, sentences):
+    return " ".join(
+        rng.choice(SENTENCES).format(
+            product=product_name(rng), region=rng.choice(REGIONS), category=rng.choice(CATEGORIES)
+        )
+        for _ in range(sentences)
+    )
+
+
+def wrap(text, width):
+    lines, line = [], ""
+    for word in text.split():
+        if line and len(line) + 1 + len(word) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    if line:
+        lines.append(line)
+    return lines
+
+
+def _pdf_string(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+def write_pdf(path, pages):
+    # `pages` is a list of pages, each a list of text lines
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Pages, filled in once the page objects are numbered
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_refs = []
+    for lines in pages:
+        text = " ".join(f"{_pdf_string(line)} '" for line in lines)
+        stream = f"BT /F1 10 Tf 14 TL 50 {PAGE_HEIGHT - 50} Td {text} ET"
+        objects.append(f"<< /Length {len(stream.encode('latin-1'))} >>\nstream\n{stream}\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+        )
+        page_refs.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(page_refs)}] /Count {len(page_refs)} >>"
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output.extend(f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1"))
+    xref = len(output)
+    output.extend(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+    output.extend("".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1"))
+    output.extend(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1"))
+    with open(path, "wb") as file:
+        file.write(output)
+
+
+def write_report_pdf(path, rng, page_count):
+    pages = []
+    for page in range(page_count):
+        lines = [f"Report section {page + 1}", ""]
+        while len(lines) < LINES_PER_PAGE:
+            lines.extend(wrap(paragraph(rng, 4), LINE_WIDTH))
+            lines.append("")
+        pages.append(lines[:LINES_PER_PAGE])
+    write_pdf(path, pages)
+
+
+def write_products_csv(path, rng, rows, file_number):
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["sku", "name", "category", "price", "stock"])
+        for row in range(rows):
+            writer.writerow([
+                f"SKU-{file_number:04d}-{row:05d}", product_name(rng), rng.choice(CATEGORIES),
+                f"{rng.uniform(5, 500):.2f}", rng.randint(0, 1000),
+            ])
+
+
+def write_orders_json(path, rng, records, file_number):
+    orders = [
+        {
+            "order_id": f"ORD-{file_number:04d}-{record:05d}",
+            "region": rng.choice(REGIONS),
+            "items": [{"product": product_name(rng), "quantity": rng.randint(1, 5)} for _ in range(rng.randint(1, 3))],
+            "note": paragraph(rng, 1),
+        }
+        for record in range(records)
+    ]
+    with open(path, "w") as file:
+        json.dump(orders, file, indent=1)
+
+
+def generate_corpus(directory, pdfs=10, pages=5, csvs=10, rows=200, jsons=10, records=100, seed=0):
+    # Writes the files into `directory` and returns their paths
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for i in range(pdfs):
+        paths.append(os.path.join(directory, f"report_{i:04d}.pdf"))
+        write_report_pdf(paths[-1], rng, pages)
+    for i in range(csvs):
+        paths.append(os.path.join(directory, f"products_{i:04d}.csv"))
+        write_products_csv(paths[-1], rng, rows, i)
+    for i in range(jsons):
+        paths.append(os.path.join(directory, f"orders_{i:04d}.json"))
+        write_orders_json(paths[-1], rng, records, i)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic corpus of PDF, CSV and JSON files")
+    parser.add_argument("directory")
+    parser.add_argument("--pdfs", type=int, default=10)
+    parser.add_argument("--pages", type=int, default=5, help="Pages per PDF")
+    parser.add_argument("--csvs", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=200, help="Rows per CSV file")
+    parser.add_argument("--jsons", type=int, default=10)
+    parser.add_argument("--records", type=int, default=100, help="Records per JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = generate_corpus(
+        args.directory, args.pdfs, args.pages, args.csvs, args.rows, args.jsons, args.records, args.seed
+    )
+    size = sum(os.path.getsize(path) for path in paths)
+    print(f"Wrote {len(paths)} files ({size / 1e6:.1f} MB) to {args.directory}")
@@ -0,0 +1,209 @@
+import io
+import os
+import base64
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from langchain_core.messages import HumanMessage
+from langchain_core.documents import Document
+from config import (
+    embedding_cache_dir, OLLAMA_BASE_URL, IMAGE_MODEL, CAPTION_IMAGE_SIZE, CAPTION_CONCURRENCY, CAPTION_DEDUPE_DISTANCE,
+)
+from metrics import ingest_stage_seconds
+
+# Captions for images without OCR text, made by the image model. Before an image is
+# sent it is downscaled to the model's input resolution and re-encoded, so a 12 MP
+# photo costs a few dozen kilobytes instead of megabytes of base64.
+#
+# Captions are cached by image content (SHA-256) next to the embedding cache, so they
+# survive a rebuild of the vector store. Every cached image also keeps a 64 bit
+# difference hash (dHash), and an image within CAPTION_DEDUPE_DISTANCE bits of a
+# captioned one reuses its caption: burst shots and resized copies are captioned once,
+# and the identical caption then shares one chunk and one embedding.
+
+CAPTION_PROMPT = (
+    "Please provide a detailed description of the content of this image. Include any relevant information, "
+    "such as objects, text, context, and any other notable details."
+)
+
+MIME_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+
+caption_cache_file = os.path.join(embedding_cache_dir, "captions.sqlite3")
+
+
+def dhash(image):
+    # Compares each pixel of a 9x8 grayscale thumbnail with its right neighbour
+    from PIL import Image
+
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def prepare_image(data, filename, max_size=CAPTION_IMAGE_SIZE):
+    # Returns (image bytes to send, MIME type, dHash). Images Pillow cannot read are
+    # sent unchanged, without a dHash.
+    try:
+        from PIL import Image, ImageOps
+
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+        fingerprint = dhash(image)
+    except Exception:
+        return data, MIME_TYPES.get(os.path.splitext(filename)[1].lower(), "image/jpeg"), None
+
+    if image.mode != "RGB":
+        # Transparent areas become white instead of black
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=90)
+    return output.getvalue(), "image/jpeg", fingerprint
+
+
+def _signed(value):
+    # SQLite integers are signed 64 bit
+    return value - (1 << 64) if value is not None and value >= (1 << 63) else value
+
+
+class CaptionCache:
+    def __init__(self, model_name, path=caption_cache_file):
+        self.model_name = model_name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS captions (
+                model TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                dhash INTEGER,
+                caption TEXT NOT NULL,
+                PRIMARY KEY (model, sha256)
+            )
+            """
+        )
+        self._conn.commit()
+        rows = self._conn.execute(
+            "SELECT sha256, dhash FROM captions WHERE model = ? AND dhash IS NOT NULL", (model_name,)
+        ).fetchall()
+        # Hashes of the cached images, for near-duplicate lookups
+        self._hash_keys = [sha256 for sha256, _ in rows]
+        self._hashes = np.array([value for _, value in rows], dtype=np.int64).view(np.uint64)
+
+    def get(self, sha256):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT caption FROM captions WHERE model = ? AND sha256 = ?", (self.model_name, sha256)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_similar(self, fingerprint, max_distance):
+        # Caption of the cached image with the closest dHash, if it is close enough
+        with self._lock:
+            if fingerprint is None or max_distance < 0 or not len(self._hashes):
+                return None
+            differences = np.bitwise_xor(self._hashes, np.uint64(fingerprint))
+            distances = np.unpackbits(differences.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+            best = int(np.argmin(distances))
+            if distances[best] > max_distance:
+                return None
+            sha256 = self._hash_keys[best]
+        return self.get(sha256)
+
+    def put(self, sha256, fingerprint, caption):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO captions (model, sha256, dhash, caption) VALUES (?, ?, ?, ?)",
+                (self.model_name, sha256, _signed(fingerprint), caption),
+            )
+            self._conn.commit()
+            if fingerprint is not None:
+                self._hash_keys.append(sha256)
+                self._hashes = np.append(self._hashes, np.uint64(fingerprint))
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM captions WHERE model = ?", (self.model_name,)).fetchone()[0]
+
+
+class Captioner:
+    # Captions images on a bounded thread pool. `submit` returns a future of the
+    # image's documents, so ingestion keeps loading and embedding other files meanwhile.
+
+    def __init__(self, model_name=IMAGE_MODEL, concurrency=CAPTION_CONCURRENCY,
+                 max_size=CAPTION_IMAGE_SIZE, dedupe_distance=CAPTION_DEDUPE_DISTANCE):
+        self.model_name = model_name
+        self.concurrency = concurrency
+        self.max_size = max_size
+        self.dedupe_distance = dedupe_distance
+        self.cache = CaptionCache(model_name)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="caption")
+        self._llm = None
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.near_duplicates = 0
+        self.captioned = 0
+
+    def _get_llm(self):
+        with self._lock:
+            if self._llm is None:
+                from langchain_community.chat_models import ChatOllama
+
+                self._llm = ChatOllama(base_url=OLLAMA_BASE_URL, model=self.model_name, keep_alive=5)
+            return self._llm
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def caption(self, file_path, source, sha256):
+        cached = self.cache.get(sha256)
+        if cached is not None:
+            self._count("cache_hits")
+            return cached
+
+        with open(file_path, "rb") as image_file:
+            data = image_file.read()
+        image_data, mime_type, fingerprint = prepare_image(data, source, self.max_size)
+
+        similar = self.cache.get_similar(fingerprint, self.dedupe_distance)
+        if similar is not None:
+            print(f"Reusing the caption of a near-duplicate image for {source}")
+            self._count("near_duplicates")
+            self.cache.put(sha256, None, similar)
+            return similar
+
+        message = HumanMessage(
+            content=[
+                {"type": "text", "text": CAPTION_PROMPT},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:{mime_type};base64,{base64.b64encode(image_data).decode('utf-8')}"},
+                },
+            ]
+        )
+        with ingest_stage_seconds.time("caption"):
+            caption = self._get_llm().invoke([message]).content
+        self._count("captioned")
+        print(f"Image description for {source}: {caption}")
+        self.cache.put(sha256, fingerprint, caption)
+        return caption
+
+    def describe(self, file_path, source, sha256):
+        return [Document(page_content=self.caption(file_path, source, sha256), metadata={"source": source})]
+
+    def submit(self, file_path, source, sha256):
+        return self._executor.submit(self.describe, file_path, source, sha256)
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "entries": self.cache.count(),
+            "cache_hits": self.cache_hits,
+            "near_duplicates": self.near_duplicates,
+            "captioned": self.captioned,
+        }
@@ -0,0 +1,81 @@
+import asyncio
+from langchain_core.messages import HumanMessage, SystemMessage
+import session_store
+from metrics import chat_stage_seconds
+from config import HISTORY_TOKEN_BUDGET, HISTORY_MAX_TURNS, HISTORY_SUMMARY_ENABLED
+
+# Chat history sent to the model. Only the most recent turns that fit the token budget
+# are sent verbatim, older turns are represented by a rolling summary stored with the
+# session. The summary is extended after a turn has been answered, never while a
+# request waits, so the prompt size of a turn does not depend on the session length.
+
+# Sessions with a summary update in progress, also keeps the tasks referenced
+_summary_tasks = {}
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for the llama tokenizers on English text.
+    # Good enough for a budget, and avoids loading a tokenizer.
+    return len(text) // 4 + 1
+
+
+def _to_message(msg):
+    return HumanMessage(content=msg["content"]) if msg["type"] == "human" else SystemMessage(content=msg["content"])
+
+
+def window_start(messages, token_budget=HISTORY_TOKEN_BUDGET, max_turns=HISTORY_MAX_TURNS):
+    # Index of the first message of the most recent whole turns (a question and its
+    # answer) that fit within `token_budget` and `max_turns`
+    start = len(messages)
+    used = 0
+    turns = 0
+    while start > 0 and turns < max_turns:
+        turn_start = max(start - 2, 0)
+        cost = sum(estimate_tokens(msg["content"]) for msg in messages[turn_start:start])
+        if used + cost > token_budget:
+            break
+        used += cost
+        start = turn_start
+        turns += 1
+    return start
+
+
+def load_prompt_history(session_id):
+    # Returns the messages to send with the next question: the summary of older turns,
+    # if any, followed by the recent turns. Turns that fell out of the window but are
+    # not summarized yet are left out until the background update catches up.
+    summary, covered = session_store.get_summary(session_id)
+    messages = session_store.load_messages(session_id, since=covered)
+    history = [_to_message(msg) for msg in messages[window_start(messages):]]
+    if summary:
+        history.insert(0, SystemMessage(content=f"Summary of the earlier conversation: {summary}"))
+    return history
+
+
+async def _update_summary(session_id, summarize):
+    summary, covered = session_store.get_summary(session_id)
+    messages = session_store.load_messages(session_id, since=covered)
+    # Fold whatever the next turn's window will not include
+    folded = window_start(messages)
+    if folded == 0:
+        return
+    with chat_stage_seconds.time("summarize"):
+        new_summary = await summarize(summary, [_to_message(msg) for msg in messages[:folded]])
+    session_store.set_summary(session_id, new_summary, covered + folded, covered)
+
+
+def schedule_summary_update(session_id, summarize):
+    # `summarize` is a coroutine function taking (summary, messages) and returning the
+    # extended summary. At most one update per session runs at a time.
+    if not HISTORY_SUMMARY_ENABLED or session_id in _summary_tasks:
+        return
+
+    async def run():
+        try:
+            await _update_summary(session_id, summarize)
+        except Exception as e:
+            print(f"Summarizing chat history failed: {str(e)}")
+        finally:
+            _summary_tasks.pop(session_id, None)
+
+    _summary_tasks[session_id] = asyncio.create_task(run())
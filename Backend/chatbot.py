@@ -1,27 +1,69 @@
-import os
-import json
+import re
+import time
+import functools
+import threading
+import asyncio
+import logging
+import contextlib
 import uvicorn
-import uuid
-import shutil
-import base64
-from langchain_community.document_loaders import PyPDFLoader, CSVLoader, UnstructuredExcelLoader, JSONLoader, UnstructuredImageLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import OllamaEmbeddings
 from langchain_community.chat_models import ChatOllama
-from langchain_chroma import Chroma
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+from langchain_core.output_parsers import StrOutputParser
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routes import router
-from langchain_core.messages import HumanMessage
+from transcription import preload_model
 from langchain_core.documents import Document
-
-# Set the environment variable to disable anonymized telemetry for Chroma
-os.environ["ANONYMIZED_TELEMETRY"] = "False"
-
-app = FastAPI()
+from config import (
+    files_dir, OLLAMA_BASE_URL, CHAT_MODEL, REPHRASE_MODEL, SUMMARY_MODEL, ANSWER_CACHE_ENABLED,
+    LOG_LEVEL, RETRIEVAL_MODE, RETRIEVAL_K, TABULAR_INGESTION_ENABLED, SQL_MODEL, STARTUP_RECONCILE_ENABLED,
+    WHISPER_PRELOAD, CONTEXT_COMPRESSION_ENABLED,
+)
+from metrics import Trace, chat_stage_seconds
+from ingest_jobs import start_worker, enqueue_job
+from answer_cache import AnswerCache
+import ingestion
+import tabular_store
+from ingestion import embeddings, persistent_directory
+from retrieval import hybrid_search, mmr_search, on_collection_change, sync_with_collection, collection_version
+from context_compression import compress_context
+from chat_memory import estimate_tokens
+from manifest import chunk_hash
+
+logging.basicConfig(level=LOG_LEVEL)
+logger = logging.getLogger("rag")
+
+# Startup does not wait for the vector store or for re-indexing, see lifespan
+startup_state = {"ready": False, "error": None, "warm_up_seconds": None, "reconcile_job": None}
+
+def warm_up():
+    # Opens the vector store and loads the vector index ahead of the first /chat
+    start = time.perf_counter()
+    try:
+        ingestion.open_vector_store()
+    except Exception as e:
+        startup_state["error"] = str(e)
+        print(f"\nOpening the vector store failed: {str(e)}")
+        return
+    startup_state["warm_up_seconds"] = round(time.perf_counter() - start, 3)
+    startup_state["ready"] = True
+    print(f"\nVector store ready after {startup_state['warm_up_seconds']}s")
+    if WHISPER_PRELOAD:
+        preload_model()
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Bringing the index up to date with the files directory is queued as an ingestion
+    # job, so it runs in the background worker like uploads and deletes do. Workers
+    # started together share one job.
+    if STARTUP_RECONCILE_ENABLED:
+        startup_state["reconcile_job"] = enqueue_job("reconcile", "", coalesce=True)
+    start_worker()
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(router)
 
@@ -34,226 +76,30 @@ app.add_middleware(
     allow_credentials=True
 )
 
-current_dir = os.path.dirname(os.path.abspath(__file__))
-files_dir = os.path.join(current_dir, "files")
-db_dir = os.path.join(current_dir, "db")
-persistent_directory = os.path.join(db_dir, "chroma_db_with_metadata")
-processed_files_file = os.path.join(db_dir, "processed_files.json")
-metadata_file = os.path.join(db_dir, "metadata.json")
-
 print(f"Files directory: {files_dir}")
 print(f"Persistent directory: {persistent_directory}")
 
-def load_processed_files():
-    if os.path.exists(processed_files_file):
-        with open(processed_files_file, "r") as file:
-            return json.load(file)
-    return []
-
-def save_processed_files(processed_files):
-    with open(processed_files_file, "w") as file:
-        json.dump(processed_files, file)
-
-def load_metadata():
-    if os.path.exists(metadata_file):
-        with open(metadata_file, "r") as file:
-            return json.load(file)
-    return {}
-
-def save_metadata(metadata):
-    with open(metadata_file, "w") as file:
-        json.dump(metadata, file)
-
-def delete_db_contents():
-    if os.path.exists(db_dir):
-        for filename in os.listdir(db_dir):
-            file_path = os.path.join(db_dir, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-            except Exception as e:
-                print(f'Failed to delete {file_path}. Reason: {e}')
-        print(f"\nDeleted the contents of the directory: {db_dir}")
-
-def update_vector_store():
-    global db
-    try:
-        processed_files = load_processed_files()
-        metadata = load_metadata()
-
-        # List all files in the directory
-        all_files = [f for f in os.listdir(files_dir) if f.endswith(('.pdf', '.csv', '.xlsx', '.json', '.jpg', '.jpeg', '.png'))]
+# Answers to /chat questions, invalidated per file by update_vector_store, see answer_cache.py.
+# Files changed by another process are not known one by one, so those clear it.
+answer_cache = AnswerCache()
+on_collection_change(answer_cache.clear)
 
-        # Identify new files
-        new_files = [f for f in all_files if f not in processed_files]
-
-        # Identify deleted files
-        deleted_files = [f for f in processed_files if f not in all_files]
-
-        # Initialize vector store
-        if os.path.exists(persistent_directory):
-            print("\nLoading existing vector store")
-            db = Chroma(embedding_function=OllamaEmbeddings(base_url="http://ollama:11434", model="mxbai-embed-large"), persist_directory=persistent_directory)
-        else:
-            print("\nCreating new vector store")
-            db = Chroma(embedding_function=OllamaEmbeddings(base_url="http://ollama:11434", model="mxbai-embed-large"), persist_directory=persistent_directory)
-
-        if not new_files and not deleted_files:
-            print("\nNo changes detected in files.")
-            return
+def update_vector_store(progress=None, check_cancel=None, include=None):
+    # Indexing itself lives in ingestion.py, the server also drops cached answers
+    # that were built from the files being changed
+    return ingestion.update_vector_store(
+        progress, check_cancel, on_change=answer_cache.invalidate_sources, include=include
+    )
 
-        # Process new files if present
-        if new_files:
-            print(f"\nNew files detected: {new_files}")
-
-            documents = []
-            chunk_metadata = {}
-            for file in new_files:
-                file_path = os.path.join(files_dir, file)
-                if file.endswith(".pdf"):
-                    print(f"Loading PDF file: {file_path}")
-                    loader = PyPDFLoader(file_path)
-                    pdf_docs = loader.load()
-                    print(f"Loaded {len(pdf_docs)} documents from {file_path}")
-                    for doc in pdf_docs:
-                        doc.metadata = {"source": file}
-                        documents.append(doc)
-                elif file.endswith(".csv"):
-                    print(f"Loading CSV file: {file_path}")
-                    loader = CSVLoader(file_path, csv_args={'delimiter': ','})
-                    csv_docs = loader.load()
-                    print(f"Loaded {len(csv_docs)} documents from {file_path}")
-                    for doc in csv_docs:
-                        doc.metadata = {"source": file}
-                        documents.append(doc)
-                elif file.endswith(".xlsx"):
-                    print(f"Loading Excel file: {file_path}")
-                    loader = UnstructuredExcelLoader(file_path)
-                    excel_docs = loader.load()
-                    print(f"Loaded {len(excel_docs)} documents from {file_path}")
-                    for doc in excel_docs:
-                        doc.metadata = {"source": file}
-                        documents.append(doc)
-                elif file.endswith(".json"):
-                    print(f"Loading JSON file: {file_path}")
-                    loader = JSONLoader(file_path, text_content=False, jq_schema=".[]")
-                    # loader = JSONLoader(file_path, text_content=False, jq_schema=".")
-                    json_docs = loader.load()
-                    print(f"Loaded {len(json_docs)} documents from {file_path}")
-                    for doc in json_docs:
-                        doc.metadata = {"source": file}
-                        documents.append(doc)
-                elif file.endswith((".png", ".jpg", ".jpeg")):
-                    print(f"Loading image file: {file_path}")
-                    loader = UnstructuredImageLoader(file_path)
-                    image_docs = loader.load()
-                    
-                    if image_docs and any(doc.page_content.strip() for doc in image_docs):
-                        print(f"Loaded {len(image_docs)} documents from {file_path} with textual content")
-                        for doc in image_docs:
-                            doc.metadata = {"source": file}
-                            documents.append(doc)
-                    else:
-                        print(f"No OCR text detected in image file: {file_path}. Using model for description.")
-                        with open(file_path, "rb") as image_file:
-                            image_data = base64.b64encode(image_file.read()).decode("utf-8")
-
-                        message = HumanMessage(
-                            content=[
-                                {"type": "text", "text": "Please provide a detailed description of the content of this image. Include any relevant information, such as objects, text, context, and any other notable details."},
-                                {
-                                    "type": "image_url",
-                                    "image_url": {"url": f"data:image/jpeg;base64,{image_data}"},
-                                },
-                            ]
-                        )
-                        ai_msg = image_llm.invoke([message])
-                        description_text = ai_msg.content
-                        print(f"Image description: {description_text}")
-                        
-                        doc = Document(page_content=description_text, metadata={"source": file})
-                        documents.append(doc)
-
-            rec_char_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000, chunk_overlap=100
-            )
-            rec_char_docs = rec_char_splitter.split_documents(documents)
-
-            print("\nDocument Chunks Information")
-            print(f"Number of document chunks: {len(rec_char_docs)}")
-
-            # Generate unique IDs for each document chunk
-            ids = [str(uuid.uuid4()) for _ in range(len(rec_char_docs))]
-
-            # Map each chunk ID to its corresponding source file
-            for chunk_id, chunk in zip(ids, rec_char_docs):
-                chunk_metadata[chunk_id] = chunk.metadata["source"]
-
-            print("\nAdding new document chunks to the vector store")
-            db.add_documents(documents=rec_char_docs, ids=ids)
-
-            # Update metadata with new IDs
-            metadata.update(chunk_metadata)
-
-        if deleted_files:
-            print(f"\nDeleted files detected: {deleted_files}")
-
-            # Find vector IDs related to deleted files
-            ids_to_delete = [id for id, source in metadata.items() if source in deleted_files]
-            if ids_to_delete:
-                print(f"\nDeleting vectors with IDs: {ids_to_delete}")
-                db.delete(ids_to_delete)
-                
-                # Remove deleted files from metadata and processed_files
-                metadata = {id: source for id, source in metadata.items() if source not in deleted_files}
-                processed_files = [file for file in processed_files if file not in deleted_files]
-
-        print("\nFinished updating vector store")
-
-        # Update processed files and metadata
-        processed_files.extend(new_files)
-        save_processed_files(processed_files)
-        save_metadata(metadata)
-
-        print("\nProcessed files and metadata updated")
+mmr_search_kwargs = {"k": RETRIEVAL_K, "fetch_k": 30, "lambda_mult": 0.7}
 
-    except Exception as e:
-        print(f"\nAn error occurred: {str(e)}")
-        delete_db_contents()
-        db = None
-        raise
-
-# Initialize `db` and retriever
-db = None
-retriever = None
-
-if not os.path.exists(persistent_directory):
-    print("\nPersistent directory does not exist. Initializing vector store...")
-    update_vector_store()
-else:
-    print("Vector store already exists. Loading existing vector store.")
-    model_name = "mxbai-embed-large"
-    embeddings = OllamaEmbeddings(base_url="http://ollama:11434", model=model_name)
-    db = Chroma(embedding_function=embeddings, persist_directory=persistent_directory)
-
-    # After loading, check for new files and update the vector store if needed
-    update_vector_store()
-
-# Initialize retriever after `db` is properly set up
-if db is not None:
-    # retriever = db.as_retriever(
-    #     search_type="similarity",
-    #     search_kwargs={"k": 5},
-    # )
-    retriever = db.as_retriever(
-        search_type="mmr",
-        search_kwargs={"k": 8, "fetch_k": 30, "lambda_mult": 0.7},
-    )
+_llms = {}
 
-text_llm = ChatOllama(base_url="http://ollama:11434", model="llama3.1", keep_alive=5)
-image_llm = ChatOllama(base_url="http://ollama:11434", model="llava-llama3", keep_alive=5)
+def get_llm(model):
+    # Chat model clients are created on first use, one per model name
+    if model not in _llms:
+        _llms[model] = ChatOllama(base_url=OLLAMA_BASE_URL, model=model, keep_alive=5)
+    return _llms[model]
 
 # Contextualize question prompt
 # This system prompt helps the AI understand that it should reformulate the question
@@ -274,11 +120,10 @@ contextualize_q_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-# Create a history-aware retriever
-# This uses the LLM to help reformulate the question based on chat history
-text_history_aware_retriever = create_history_aware_retriever(
-    text_llm, retriever, contextualize_q_prompt
-)
+# Create a chain that reformulates the question based on chat history
+@functools.cache
+def rephrase_chain():
+    return contextualize_q_prompt | get_llm(REPHRASE_MODEL) | StrOutputParser()
 
 # Answer question prompt
 # This system prompt helps the AI understand that it should provide concise answers
@@ -302,11 +147,128 @@ qa_prompt_text = ChatPromptTemplate.from_messages(
 )
 
 # Create a chain to combine documents for question answering
-# `create_stuff_documents_chain` feeds all retrieved context into the LLM
-text_question_answer_chain = create_stuff_documents_chain(text_llm, qa_prompt_text)
+# `create_stuff_documents_chain` feeds the retrieved context into the LLM, compressed first
+# unless CONTEXT_COMPRESSION_ENABLED is off
+@functools.cache
+def text_question_answer_chain():
+    return create_stuff_documents_chain(get_llm(CHAT_MODEL), qa_prompt_text)
+
+# SQL prompt
+# When the retrieved context includes table descriptions, the question is also answered
+# with a query against those tables and the result is added to the context
+sql_system_prompt = (
+    "You write SQLite queries. Given the tables below, write one SELECT query that answers "
+    "the user's question, using only the listed tables and columns. Add a LIMIT when the "
+    "query returns individual rows. If the tables cannot answer the question, reply with NONE. "
+    "Reply with the SQL query only."
+    "\n\n"
+    "{schema}"
+)
+
+sql_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", sql_system_prompt),
+        ("human", "{input}"),
+    ]
+)
+
+@functools.cache
+def sql_chain():
+    return sql_prompt | get_llm(SQL_MODEL) | StrOutputParser()
+
+def extract_sql(response):
+    # Models often wrap the query in a code block
+    match = re.search(r"```(?:sql)?\s*(.*?)```", response, re.DOTALL | re.IGNORECASE)
+    sql = (match.group(1) if match else response).strip()
+    return sql if re.match(r"(?is)^(select|with)\b", sql) else None
+
+async def query_tables(question, tables):
+    schema = "\n\n".join(description for _, _, description in tables)
+    sql = extract_sql(await sql_chain().ainvoke({"schema": schema, "input": question}))
+    if sql is None:
+        return None
+    try:
+        columns, rows, truncated = await asyncio.to_thread(tabular_store.run_query, sql)
+    except tabular_store.QueryError as e:
+        logger.info("Table query failed: %s\n%s", str(e), sql)
+        return None
+    result = tabular_store.format_result(columns, rows, truncated)
+    content = f"Result of the SQL query {sql} on the uploaded tables:\n{result}"
+    sources = ", ".join(sorted({source for _, source, _ in tables}))
+    return Document(page_content=content, metadata={"source": sources, "chunk_id": chunk_hash(content)})
+
+def retrieve(question, question_vector, sources=None):
+    # `sources` optionally limits retrieval to the chunks of the given files. The
+    # store is reopened when another process changed the collection.
+    db = ingestion.open_vector_store(collection_version())
+    sync_with_collection()
+    if RETRIEVAL_MODE == "hybrid":
+        return hybrid_search(db, question, question_vector, sources=sources)
+    return mmr_search(db, question_vector, **mmr_search_kwargs, sources=sources)
+
+async def contextualize_question(query, chat_history):
+    # Without chat history the query is already standalone
+    if not chat_history:
+        return query
+    return await rephrase_chain().ainvoke({"input": query, "chat_history": chat_history})
+
+async def stream_rag_answer(query, chat_history, sources=None):
+    # Rephrase, retrieve, then answer from the cache or stream a new answer from the LLM.
+    # Every stage is timed, see metrics.py.
+    trace = Trace(chat_stage_seconds, "chat", history_messages=len(chat_history))
+
+    with trace.span("rephrase"):
+        question = await contextualize_question(query, chat_history)
+    with trace.span("embed"):
+        question_vector = await asyncio.to_thread(embeddings.embed_query, question)
+    with trace.span("retrieve"):
+        context = await asyncio.to_thread(retrieve, question, question_vector, sources)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for doc in context:
+            logger.debug("Source: %s\nContent:\n%s\n%s", doc.metadata["source"], doc.page_content, "-" * 80)
+
+    chunk_ids = [doc.metadata.get("chunk_id", doc.page_content) for doc in context]
+    if ANSWER_CACHE_ENABLED:
+        cached_answer = answer_cache.lookup(question_vector, chunk_ids)
+        if cached_answer is not None:
+            trace.attributes["answer_cache"] = "hit"
+            trace.record("first_token", trace.since_start())
+            yield cached_answer
+            trace.finish()
+            return
 
-# Create a retrieval chain that combines the history-aware retriever and the question answering chain
-text_rag_chain = create_retrieval_chain(text_history_aware_retriever, text_question_answer_chain)
+    # Merged, deduplicated and reranked within the token budget, see context_compression.py
+    prompt_context = context
+    if CONTEXT_COMPRESSION_ENABLED:
+        with trace.span("compress"):
+            prompt_context = await asyncio.to_thread(compress_context, question, question_vector, context)
+        trace.attributes["context_tokens"] = sum(estimate_tokens(doc.page_content) for doc in prompt_context)
+
+    # Questions routed to spreadsheet tables are also answered with SQL
+    tables = []
+    if TABULAR_INGESTION_ENABLED:
+        tables = tabular_store.tables_for_sources({doc.metadata["source"] for doc in context})
+    if tables:
+        with trace.span("sql"):
+            table_result = await query_tables(question, tables)
+        if table_result is not None:
+            context = [table_result, *context]
+            prompt_context = [table_result, *prompt_context]
+
+    response_chunks = []
+    generation_start = time.perf_counter()
+    async for chunk in text_question_answer_chain().astream({"input": query, "chat_history": chat_history, "context": prompt_context}):
+        if not response_chunks:
+            trace.record("first_token", trace.since_start())
+        response_chunks.append(chunk)
+        yield chunk
+    trace.record("generate", time.perf_counter() - generation_start)
+    trace.finish()
+
+    if ANSWER_CACHE_ENABLED:
+        context_sources = {doc.metadata["source"] for doc in context}
+        answer_cache.store(question, question_vector, chunk_ids, context_sources, "".join(response_chunks))
 
 # Title Generation Prompt
 title_generation_prompt = ChatPromptTemplate.from_messages(
@@ -316,10 +278,27 @@ title_generation_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-def generate_title(llm, query):
-    prompt = title_generation_prompt.invoke({"input": query})
-    result = llm.invoke(prompt)
+async def generate_title(llm, query):
+    prompt = await title_generation_prompt.ainvoke({"input": query})
+    result = await llm.ainvoke(prompt)
     return result.content
 
+# History Summary Prompt
+# Older turns are folded into the running summary a few at a time, see chat_memory.py
+summary_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", "You maintain a running summary of a conversation between a user and an assistant. Extend the current summary with the new messages below. Keep the facts, names, numbers and open questions the user may refer back to, drop pleasantries, and keep the summary under 200 words. Return only the summary.\n\nCurrent summary:\n{summary}"),
+        MessagesPlaceholder("messages"),
+        ("human", "Return the updated summary."),
+    ]
+)
+
+@functools.cache
+def summary_chain():
+    return summary_prompt | get_llm(SUMMARY_MODEL) | StrOutputParser()
+
+async def summarize_history(summary, messages):
+    return await summary_chain().ainvoke({"summary": summary or "(empty)", "messages": messages})
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,99 @@
+import os
+
+# Shared paths and tunables. Every value can be overridden through an environment
+# variable so the same code runs in docker-compose, locally and in benchmarks.
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+files_dir = os.getenv("FILES_DIR", os.path.join(current_dir, "files"))
+db_dir = os.getenv("DB_DIR", os.path.join(current_dir, "db"))
+chat_sessions_dir = os.getenv("CHAT_SESSIONS_DIR", os.path.join(current_dir, "chat_sessions"))
+jobs_dir = os.getenv("JOBS_DIR", os.path.join(current_dir, "jobs"))
+# Kept outside db_dir so cached embeddings survive a rebuild of the vector store
+embedding_cache_dir = os.getenv("EMBEDDING_CACHE_DIR", os.path.join(current_dir, "embedding_cache"))
+
+# Ollama server used for chat, image and embedding models
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://ollama:11434")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "mxbai-embed-large")
+CHAT_MODEL = os.getenv("CHAT_MODEL", "llama3.1")
+IMAGE_MODEL = os.getenv("IMAGE_MODEL", "llava-llama3")
+# A smaller model can be used for the short rephrase and title calls
+REPHRASE_MODEL = os.getenv("REPHRASE_MODEL", CHAT_MODEL)
+TITLE_MODEL = os.getenv("TITLE_MODEL", REPHRASE_MODEL)
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", REPHRASE_MODEL)
+
+# Embedding cache limits, in bytes
+EMBEDDING_CACHE_MEMORY_BYTES = int(os.getenv("EMBEDDING_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+EMBEDDING_CACHE_DISK_BYTES = int(os.getenv("EMBEDDING_CACHE_DISK_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Background ingestion queue
+ingest_jobs_file = os.path.join(jobs_dir, "ingest_jobs.sqlite3")
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "1.0"))
+
+# Embedding stage of ingestion: chunks are embedded in batches with bounded concurrency
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "3"))
+EMBED_RETRY_BACKOFF = float(os.getenv("EMBED_RETRY_BACKOFF", "1.0"))
+
+# Document loading: files are parsed in a process pool, with a bound on how many
+# parsed files are held in memory at once
+LOADER_WORKERS = int(os.getenv("LOADER_WORKERS", str(os.cpu_count() or 1)))
+LOADER_MAX_IN_FLIGHT = int(os.getenv("LOADER_MAX_IN_FLIGHT", str(2 * LOADER_WORKERS)))
+
+# Captions for images without OCR text: images are downscaled to the image model's
+# input resolution, captions are cached by image content, and images whose dHash is
+# within CAPTION_DEDUPE_DISTANCE bits of a captioned one reuse its caption (-1 disables)
+CAPTION_IMAGE_SIZE = int(os.getenv("CAPTION_IMAGE_SIZE", "336"))
+CAPTION_CONCURRENCY = int(os.getenv("CAPTION_CONCURRENCY", "2"))
+CAPTION_DEDUPE_DISTANCE = int(os.getenv("CAPTION_DEDUPE_DISTANCE", "4"))
+
+# Semantic answer cache for /chat
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+
+# Retrieval for /chat: "hybrid" fuses vector and BM25 keyword search, "mmr" is the
+# previous Chroma MMR retriever
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").lower()
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "8"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Retrieval runs on an in-process NumPy copy of the embeddings, optionally memory-mapped
+VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "true").lower() == "true"
+VECTOR_INDEX_MMAP = os.getenv("VECTOR_INDEX_MMAP", "false").lower() == "true"
+# Retrieved chunks are deduplicated, reranked, trimmed to a token budget and merged with
+# their neighbours from the same file before they go into the prompt
+CONTEXT_COMPRESSION_ENABLED = os.getenv("CONTEXT_COMPRESSION_ENABLED", "true").lower() == "true"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+
+# CSV and XLSX files are loaded into SQLite tables and queried with SQL, only their
+# schema and a few sample rows are embedded
+TABULAR_INGESTION_ENABLED = os.getenv("TABULAR_INGESTION_ENABLED", "true").lower() == "true"
+TABULAR_SAMPLE_ROWS = int(os.getenv("TABULAR_SAMPLE_ROWS", "5"))
+TABLE_QUERY_MAX_ROWS = int(os.getenv("TABLE_QUERY_MAX_ROWS", "50"))
+TABLE_QUERY_TIMEOUT = float(os.getenv("TABLE_QUERY_TIMEOUT", "5.0"))
+SQL_MODEL = os.getenv("SQL_MODEL", CHAT_MODEL)
+
+# Chat history sent to the model: the most recent turns that fit the token budget,
+# with older turns folded into a rolling summary in the background
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "6"))
+HISTORY_SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY_ENABLED", "true").lower() == "true"
+
+# Startup: the server answers right away, the vector store is opened and the index is
+# reconciled with the files directory in the background. Whisper is loaded on the
+# first audio request unless preloaded.
+STARTUP_RECONCILE_ENABLED = os.getenv("STARTUP_RECONCILE_ENABLED", "true").lower() == "true"
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")
+WHISPER_PRELOAD = os.getenv("WHISPER_PRELOAD", "false").lower() == "true"
+
+# Audio transcription for /ws/audio_chat: a pool of workers with one Whisper model
+# each. Partial transcripts are skipped while too many transcriptions are waiting.
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", "1"))
+TRANSCRIBE_MAX_PENDING = int(os.getenv("TRANSCRIBE_MAX_PENDING", "4"))
+TRANSCRIBE_PARTIAL_INTERVAL = float(os.getenv("TRANSCRIBE_PARTIAL_INTERVAL", "2.0"))
+AUDIO_MAX_BYTES = int(os.getenv("AUDIO_MAX_BYTES", str(25 * 1024 * 1024)))
+
+# Logging and tracing. Retrieved chunks are dumped at DEBUG level only.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+TRACE_REQUESTS = os.getenv("TRACE_REQUESTS", "false").lower() == "true"
@@ -0,0 +1,136 @@
+from langchain_core.documents import Document
+import sparse_index
+from chat_memory import estimate_tokens
+from retrieval import vector_index, chunk_positions, query_term_weights
+from config import CONTEXT_TOKEN_BUDGET
+
+# Retrieved chunks on their way into the prompt. Chunks are 1000 characters and
+# neighbouring chunks of a file overlap by 100, and neighbours are often retrieved
+# together, so stuffing them verbatim makes the model prefill repeated text on every
+# turn. Instead the chunks are
+#
+#   1. deduplicated: a chunk whose text, ignoring case and whitespace, is contained in
+#      another retrieved chunk is dropped
+#   2. scored: cosine similarity to the question from the in-process vector index, plus
+#      LEXICAL_WEIGHT times the share of the question's terms the chunk contains, each
+#      term weighted by its BM25 IDF in the keyword index
+#   3. selected best first while they fit CONTEXT_TOKEN_BUDGET
+#   4. merged: selected chunks next to each other in the same file become one passage
+#      without the overlap between them
+#
+# The passages are returned best first.
+
+LEXICAL_WEIGHT = 0.3
+# Shortest and longest run of characters taken for splitter overlap when merging
+MIN_OVERLAP = 10
+MAX_OVERLAP = 200
+
+
+def _normalized(text):
+    return " ".join(text.lower().split())
+
+
+def deduplicate(documents):
+    # Keeps the first of identical chunks and drops chunks contained in a longer one
+    normalized = [_normalized(doc.page_content) for doc in documents]
+    kept = []
+    for index in sorted(range(len(documents)), key=lambda i: -len(normalized[i])):
+        if not any(normalized[index] in normalized[other] for other in kept):
+            kept.append(index)
+    return [documents[index] for index in sorted(kept)]
+
+
+def score(document, similarities, weights):
+    similarity = similarities.get(document.metadata.get("chunk_id"), 0.0)
+    total = sum(weights.values())
+    if not total:
+        return similarity
+    present = set(sparse_index.terms(document.page_content))
+    return similarity + LEXICAL_WEIGHT * sum(weight for term, weight in weights.items() if term in present) / total
+
+
+def _truncate(text, tokens):
+    # Cuts at the last whitespace within roughly `tokens` tokens
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    cut = max(text.rfind(" ", 0, limit), text.rfind("\n", 0, limit))
+    return text[:cut if cut > 0 else limit].rstrip() + " ..."
+
+
+def select(scored, token_budget):
+    # `scored` is [(score, document)]. Returns the best that fit the budget, best first.
+    # Only a best chunk larger than the whole budget is cut to fit.
+    ranked = sorted(scored, key=lambda item: -item[0])
+    if token_budget <= 0:
+        return ranked
+    selected = []
+    used = 0
+    for chunk_score, document in ranked:
+        tokens = estimate_tokens(document.page_content)
+        if used + tokens <= token_budget:
+            selected.append((chunk_score, document))
+            used += tokens
+        elif not selected:
+            text = _truncate(document.page_content, token_budget)
+            selected.append((chunk_score, Document(page_content=text, metadata=document.metadata)))
+            used += estimate_tokens(text)
+    return selected
+
+
+def join_overlapping(previous, text):
+    # The splitter starts a chunk with up to its overlap from the end of the previous one
+    for size in range(min(len(previous), len(text), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if previous.endswith(text[:size]):
+            return previous + text[size:]
+    return previous + "\n" + text
+
+
+def _merge_run(run):
+    # `run` is [(score, document)] of consecutive chunks of one file, in file order
+    if len(run) == 1:
+        return run[0]
+    text = run[0][1].page_content
+    for _, document in run[1:]:
+        text = join_overlapping(text, document.page_content)
+    metadata = dict(run[0][1].metadata, chunk_ids=[document.metadata["chunk_id"] for _, document in run])
+    return max(chunk_score for chunk_score, _ in run), Document(page_content=text, metadata=metadata)
+
+
+def merge_neighbours(selected, positions):
+    # `positions` maps (source, chunk_id) to the chunk's position in the file. Chunks
+    # without a position, e.g. from the Chroma fallback, stay passages of their own.
+    passages = []
+    located = []
+    for chunk_score, document in selected:
+        source = document.metadata.get("source")
+        position = positions.get((source, document.metadata.get("chunk_id")))
+        if position is None:
+            passages.append((chunk_score, document))
+        else:
+            located.append((source, position, chunk_score, document))
+
+    located.sort(key=lambda item: (item[0], item[1]))
+    run = []
+    for source, position, chunk_score, document in located:
+        if run and (source != run[-1][0] or position != run[-1][1] + 1):
+            passages.append(_merge_run([(item[2], item[3]) for item in run]))
+            run = []
+        run.append((source, position, chunk_score, document))
+    if run:
+        passages.append(_merge_run([(item[2], item[3]) for item in run]))
+
+    passages.sort(key=lambda item: -item[0])
+    return passages
+
+
+def compress_context(question, vector, documents, token_budget=CONTEXT_TOKEN_BUDGET):
+    if not documents:
+        return documents
+    documents = deduplicate(documents)
+    chunk_ids = [doc.metadata["chunk_id"] for doc in documents if "chunk_id" in doc.metadata]
+    similarities = vector_index.similarities(vector, chunk_ids)
+    weights = query_term_weights(question)
+    scored = [(score(doc, similarities, weights), doc) for doc in documents]
+    passages = merge_neighbours(select(scored, token_budget), chunk_positions(chunk_ids))
+    return [document for _, document in passages]
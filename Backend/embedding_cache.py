@@ -0,0 +1,207 @@
+import os
+import re
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from config import embedding_cache_dir, EMBEDDING_CACHE_MEMORY_BYTES, EMBEDDING_CACHE_DISK_BYTES
+
+# Two tier cache for embeddings keyed by (model name, SHA-256 of the text).
+# The disk tier stores vectors as float32 rows in a memory-mapped file used as a ring
+# buffer, so once the byte limit is reached the oldest rows are overwritten. A small
+# SQLite table maps keys to rows. Recently used vectors are also kept in an in-memory
+# LRU bounded by bytes.
+#
+# Several processes can share the disk tier: rows are allocated inside a SQLite write
+# transaction from the shared counter, and a process remaps the file when another one
+# has grown it.
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, model_name, cache_dir=embedding_cache_dir,
+                 memory_bytes=EMBEDDING_CACHE_MEMORY_BYTES, disk_bytes=EMBEDDING_CACHE_DISK_BYTES):
+        self.model_name = model_name
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.model_dir = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+        os.makedirs(self.model_dir, exist_ok=True)
+        self.vectors_file = os.path.join(self.model_dir, "vectors.f32")
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._vectors = None
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._conn = sqlite3.connect(os.path.join(self.model_dir, "index.sqlite3"), timeout=30, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER NOT NULL UNIQUE)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.commit()
+        meta = dict(self._conn.execute("SELECT name, value FROM meta").fetchall())
+        self.dim = meta.get("dim")
+        self._next_slot = meta.get("next_slot", 0)
+        if self.dim is not None:
+            self._open_vectors()
+
+    @property
+    def _max_rows(self):
+        return max(1, self.disk_bytes // (self.dim * 4))
+
+    def _open_vectors(self, min_rows=0):
+        # The file grows by doubling up to the disk limit and is remapped when it does
+        allocated = os.path.getsize(self.vectors_file) // (self.dim * 4) if os.path.exists(self.vectors_file) else 0
+        if allocated < min_rows:
+            allocated = min(self._max_rows, max(1024, allocated * 2, min_rows))
+            with open(self.vectors_file, "ab") as file:
+                file.truncate(allocated * self.dim * 4)
+        self._vectors = np.memmap(self.vectors_file, dtype=np.float32, mode="r+", shape=(allocated, self.dim))
+
+    def _remember(self, key, vector):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = vector
+        self._memory_used += vector.nbytes
+        while self._memory_used > self.memory_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= evicted.nbytes
+
+    def get_many(self, keys):
+        results = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    results[key] = self._memory[key]
+                    self.memory_hits += 1
+                else:
+                    missing.append(key)
+
+            if missing and self.dim is None:
+                # Another process may have stored the first vector
+                row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+                self.dim = row[0] if row else None
+            if missing and self.dim is not None:
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = self._conn.execute(
+                        f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                    for key, slot in rows:
+                        if self._vectors is None or slot >= self._vectors.shape[0]:
+                            self._open_vectors()
+                        vector = np.array(self._vectors[slot])
+                        results[key] = vector
+                        self._remember(key, vector)
+
+            found = sum(1 for key in keys if key in results)
+            self.hits += found
+            self.misses += len(keys) - found
+        return results
+
+    def put_many(self, items):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._put_many(items)
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            if self._vectors is not None:
+                self._vectors.flush()
+
+    def _put_many(self, items):
+        # Runs in a write transaction, the counters may have moved in another process
+        meta = dict(self._conn.execute("SELECT name, value FROM meta").fetchall())
+        self.dim = meta.get("dim", self.dim)
+        self._next_slot = meta.get("next_slot", self._next_slot)
+        for key, vector in items:
+            vector = np.asarray(vector, dtype=np.float32)
+            if self.dim is None:
+                self.dim = vector.shape[0]
+                self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (self.dim,))
+            if vector.shape[0] != self.dim:
+                continue
+            self._remember(key, vector)
+            if self._conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone():
+                continue
+
+            slot = self._next_slot % self._max_rows
+            if self._vectors is None or slot >= self._vectors.shape[0]:
+                self._open_vectors(slot + 1)
+            # Overwriting a slot evicts the entry that was stored there
+            if self._conn.execute("DELETE FROM entries WHERE slot = ?", (slot,)).rowcount:
+                self.evictions += 1
+            self._vectors[slot] = vector
+            self._conn.execute("INSERT INTO entries (key, slot) VALUES (?, ?)", (key, slot))
+            self._next_slot = slot + 1
+
+        self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('next_slot', ?)", (self._next_slot,))
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model_name,
+                "entries": entries,
+                "disk_bytes": entries * (self.dim or 0) * 4,
+                "disk_limit_bytes": self.disk_bytes,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "memory_limit_bytes": self.memory_bytes,
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps an embeddings client so ingestion and retrieval share one cache
+
+    def __init__(self, embeddings, model_name):
+        self.embeddings = embeddings
+        self.cache = EmbeddingCache(model_name)
+        # Ollama embeds documents and queries with different instruction prefixes
+        self.document_prefix = getattr(embeddings, "embed_instruction", "")
+        self.query_prefix = getattr(embeddings, "query_instruction", "")
+
+    def embed_documents(self, texts):
+        keys = [text_hash(self.document_prefix + text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        # Embed each distinct missing text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing, vectors))
+            self.cache.put_many(new_items)
+            cached.update((key, np.asarray(vector, dtype=np.float32)) for key, vector in new_items)
+
+        return [cached[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        key = text_hash(self.query_prefix + text)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            return cached[key].tolist()
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many([(key, vector)])
+        return list(vector)
@@ -0,0 +1,87 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from config import EMBED_BATCH_SIZE, EMBED_CONCURRENCY, EMBED_MAX_RETRIES, EMBED_RETRY_BACKOFF
+
+# Embedding stage of ingestion. Chunks are split into batches, a bounded number of
+# batches is embedded concurrently, failed batches are retried with exponential
+# backoff, and every finished batch is written to Chroma as soon as it lands so a
+# late failure does not lose the work already done.
+
+
+class EmbeddingBatchError(Exception):
+    pass
+
+
+def _embed_batch(embeddings, texts, max_retries, retry_backoff):
+    attempt = 0
+    while True:
+        try:
+            return embeddings.embed_documents(texts)
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            delay = retry_backoff * (2 ** attempt)
+            print(f"Embedding batch failed ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def _write_batch(db, ids, documents, vectors):
+    db._collection.upsert(
+        ids=ids,
+        embeddings=vectors,
+        documents=[doc.page_content for doc in documents],
+        metadatas=[doc.metadata for doc in documents],
+    )
+
+
+def embed_and_store(db, embeddings, documents, ids, batch_size=EMBED_BATCH_SIZE, concurrency=EMBED_CONCURRENCY,
+                    max_retries=EMBED_MAX_RETRIES, retry_backoff=EMBED_RETRY_BACKOFF, progress=None, check_cancel=None,
+                    on_batch=None):
+    # `on_batch(ids, vectors)` is called after each batch is written to Chroma
+    batches = [
+        (ids[start:start + batch_size], documents[start:start + batch_size])
+        for start in range(0, len(documents), batch_size)
+    ]
+    written_ids = []
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        next_batch = 0
+        while next_batch < len(batches) or pending:
+            # Keep at most `concurrency` batches in flight
+            while next_batch < len(batches) and len(pending) < concurrency:
+                if check_cancel is not None:
+                    check_cancel()
+                batch_ids, batch_docs = batches[next_batch]
+                future = executor.submit(
+                    _embed_batch, embeddings, [doc.page_content for doc in batch_docs], max_retries, retry_backoff
+                )
+                pending[future] = next_batch
+                next_batch += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch_ids, batch_docs = batches[pending.pop(future)]
+                try:
+                    vectors = future.result()
+                except Exception as e:
+                    for other in pending:
+                        other.cancel()
+                    stored = len(written_ids)
+                    raise EmbeddingBatchError(
+                        f"Embedding stopped after {stored} of {len(ids)} chunks: {str(e)}"
+                    ) from e
+                _write_batch(db, batch_ids, batch_docs, vectors)
+                if on_batch is not None:
+                    on_batch(batch_ids, vectors)
+                written_ids.extend(batch_ids)
+                if progress is not None:
+                    progress("embed", len(written_ids), len(ids))
+
+    stored = len(written_ids)
+    elapsed = time.perf_counter() - start_time
+    rate = stored / elapsed if elapsed > 0 else 0.0
+    print(f"Embedded {stored} chunks in {elapsed:.1f}s ({rate:.1f} chunks/s)")
+    return {"chunks": stored, "seconds": elapsed, "chunks_per_second": rate}
@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+
+# Bulk ingestion from the command line. Indexes a directory tree with the same code
+# and into the same stores the server uses (vector store, manifest, keyword index,
+# table store), so an index can be built offline and shipped: start the server with
+# FILES_DIR pointing at the same tree and DB_DIR at the output directory.
+#
+# Every file is committed on its own, so an interrupted run resumes where it stopped
+# when started again. Files whose content is already indexed are skipped.
+#
+#   python ingest_cli.py /data/docs --db-dir /data/db --workers 8 --include "*.pdf"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Index a directory tree for the RAG chatbot")
+    parser.add_argument("root", nargs="?", help="Directory to ingest, recursively (default: FILES_DIR)")
+    parser.add_argument("--db-dir", help="Where to write the index (default: DB_DIR)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Document loading processes")
+    parser.add_argument("--embed-concurrency", type=int, help="Embedding batches in flight")
+    parser.add_argument("--embed-batch-size", type=int, help="Chunks per embedding request")
+    parser.add_argument("--include", action="append", metavar="GLOB",
+                        help="Only ingest paths matching this glob, relative to the root. Repeatable.")
+    parser.add_argument("--exclude", action="append", metavar="GLOB",
+                        help="Skip paths matching this glob, relative to the root. Repeatable.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be added, changed or removed")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Discard the existing index first instead of resuming from it. Cached embeddings are kept.")
+    return parser.parse_args()
+
+
+def configure(args):
+    # config.py reads the environment on import, so this runs before anything imports it.
+    # Loader worker processes inherit the environment.
+    if args.root:
+        os.environ["FILES_DIR"] = os.path.abspath(args.root)
+    if args.db_dir:
+        os.environ["DB_DIR"] = os.path.abspath(args.db_dir)
+    os.environ["LOADER_WORKERS"] = str(args.workers)
+    os.environ.pop("LOADER_MAX_IN_FLIGHT", None)
+    if args.embed_concurrency:
+        os.environ["EMBED_CONCURRENCY"] = str(args.embed_concurrency)
+    if args.embed_batch_size:
+        os.environ["EMBED_BATCH_SIZE"] = str(args.embed_batch_size)
+    # Retrieval is not needed here, so skip loading every vector into memory
+    os.environ["VECTOR_INDEX_ENABLED"] = "false"
+
+
+def discard_index():
+    import manifest
+    import tabular_store
+    import vector_index
+    from ingestion import persistent_directory
+
+    # Waits for ingestion in other processes. Servers using the index need a restart afterwards.
+    with manifest.index_lock():
+        shutil.rmtree(persistent_directory, ignore_errors=True)
+        for path in (manifest.manifest_db_file, manifest.journal_file, tabular_store.tables_db_file,
+                     vector_index.vector_index_file):
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    print(f"Discarded the index in {os.path.dirname(manifest.manifest_db_file)}")
+
+
+class ProgressPrinter:
+    # Prints one line per loaded file and at most one embedding update per second
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last_embed_report = 0.0
+
+    def __call__(self, stage, done, total):
+        elapsed = time.perf_counter() - self.start
+        if stage == "load":
+            print(f"[{elapsed:7.1f}s] loaded {done}/{total} files ({done / elapsed:.2f} files/s)", flush=True)
+        elif stage == "embed" and (done == total or elapsed - self.last_embed_report >= 1.0):
+            self.last_embed_report = elapsed
+            print(f"[{elapsed:7.1f}s]   embedded {done}/{total} chunks of the current file", flush=True)
+
+
+def main():
+    args = parse_args()
+    configure(args)
+
+    from config import files_dir, db_dir
+    if not os.path.isdir(files_dir):
+        sys.exit(f"Not a directory: {files_dir}")
+    print(f"Ingesting {files_dir} into {db_dir} with {args.workers} loader workers")
+
+    if args.rebuild and not args.dry_run:
+        discard_index()
+
+    from ingestion import update_vector_store, list_source_files
+
+    selected = list_source_files(files_dir, args.include, args.exclude)
+    print(f"{len(selected)} supported files selected")
+
+    start = time.perf_counter()
+    summary = update_vector_store(
+        progress=ProgressPrinter(), include=args.include, exclude=args.exclude, dry_run=args.dry_run
+    )
+    elapsed = time.perf_counter() - start
+
+    if args.dry_run:
+        print(
+            f"\nDry run: {summary['files']} files to index, {summary['renamed']} renamed, "
+            f"{summary['deleted']} to remove, {len(selected) - summary['files'] - summary['renamed']} unchanged"
+        )
+        return
+
+    def rate(count):
+        return count / elapsed if elapsed > 0 else 0.0
+
+    failed = summary["failed"]
+    print(
+        f"\nIndexed {summary['files'] - len(failed)} files ({summary['renamed']} renamed, {summary['deleted']} removed) "
+        f"in {elapsed:.1f}s"
+    )
+    if failed:
+        print(f"{len(failed)} files could not be indexed and are skipped until they change:")
+        for file, error in failed.items():
+            print(f"  {file}: {error}")
+    print(
+        f"Throughput: {rate(summary['files']):.2f} files/s, {rate(summary['chunks']):.1f} chunks/s, "
+        f"{rate(summary['embedded']):.1f} embeddings/s ({summary['embedded']} of {summary['chunks']} chunks embedded)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import os
+import glob
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from config import files_dir, jobs_dir, ingest_jobs_file, INGEST_POLL_INTERVAL
+from manifest import index_lock
+from ingestion import IngestionCancelled
+
+# Persistent queue of ingestion jobs. Uploads and deletes only record a job here
+# and return its ID; a background worker runs `update_vector_store()` outside the
+# event loop so `/chat` streams are not blocked while a large file is processed.
+# Upload and delete jobs only index or remove their own file, reconcile jobs bring
+# the whole files directory up to date.
+#
+# Every server process runs a worker. They share the queue, and a worker only claims
+# and runs a job while holding the index lock, so one job runs at a time overall.
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+
+_db_lock = threading.Lock()
+_wakeup = threading.Event()
+_worker = None
+
+if not os.path.exists(jobs_dir):
+    os.makedirs(jobs_dir)
+
+
+def _connect():
+    conn = sqlite3.connect(ingest_jobs_file, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+_conn = _connect()
+_conn.execute(
+    """
+    CREATE TABLE IF NOT EXISTS ingest_jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        status TEXT NOT NULL,
+        stage TEXT,
+        progress TEXT NOT NULL DEFAULT '{}',
+        error TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """
+)
+_conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, created_at)")
+_conn.commit()
+
+
+def _row_to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["progress"] = json.loads(job["progress"])
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    return job
+
+
+def enqueue_job(kind, filename, coalesce=False):
+    # With `coalesce`, an identical job that is still queued is reused
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    with _db_lock:
+        if coalesce:
+            row = _conn.execute(
+                "SELECT id FROM ingest_jobs WHERE kind = ? AND filename = ? AND status = ?", (kind, filename, QUEUED)
+            ).fetchone()
+            if row is not None:
+                return row["id"]
+        _conn.execute(
+            "INSERT INTO ingest_jobs (id, kind, filename, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, kind, filename, QUEUED, now, now),
+        )
+        _conn.commit()
+    _wakeup.set()
+    return job_id
+
+
+def get_job(job_id):
+    with _db_lock:
+        row = _conn.execute("SELECT * FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone()
+    return _row_to_job(row)
+
+
+def list_jobs(limit=50):
+    with _db_lock:
+        rows = _conn.execute("SELECT * FROM ingest_jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+    return [_row_to_job(row) for row in rows]
+
+
+def request_cancel(job_id):
+    # Queued jobs are cancelled right away, running jobs stop at the next checkpoint
+    with _db_lock:
+        row = _conn.execute("SELECT * FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        if row["status"] == QUEUED:
+            _conn.execute(
+                "UPDATE ingest_jobs SET status = ?, cancel_requested = 1, updated_at = ? WHERE id = ?",
+                (CANCELLED, time.time(), job_id),
+            )
+        elif row["status"] == RUNNING:
+            _conn.execute(
+                "UPDATE ingest_jobs SET cancel_requested = 1, updated_at = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+        _conn.commit()
+    if row["status"] == QUEUED:
+        _discard_upload(_row_to_job(row))
+    return get_job(job_id)
+
+
+def _update_job(job_id, **fields):
+    fields["updated_at"] = time.time()
+    if "progress" in fields:
+        fields["progress"] = json.dumps(fields["progress"])
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with _db_lock:
+        _conn.execute(f"UPDATE ingest_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        _conn.commit()
+
+
+def _cancel_requested(job_id):
+    with _db_lock:
+        row = _conn.execute("SELECT cancel_requested FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone()
+    return row is not None and bool(row["cancel_requested"])
+
+
+def _next_job():
+    with _db_lock:
+        row = _conn.execute(
+            "SELECT * FROM ingest_jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+        ).fetchone()
+        if row is None:
+            return None
+        _conn.execute(
+            "UPDATE ingest_jobs SET status = ?, updated_at = ? WHERE id = ?", (RUNNING, time.time(), row["id"])
+        )
+        _conn.commit()
+    return _row_to_job(row)
+
+
+def _has_other_upload(job):
+    with _db_lock:
+        row = _conn.execute(
+            "SELECT 1 FROM ingest_jobs WHERE kind = 'upload' AND filename = ? AND id != ? AND status IN (?, ?) LIMIT 1",
+            (job["filename"], job["id"], QUEUED, RUNNING),
+        ).fetchone()
+    return row is not None
+
+
+def _discard_upload(job):
+    # Drop the uploaded file of a cancelled or failed upload, so the next job does not
+    # pick it up again. Whatever of it was already committed, or an earlier file of the
+    # same name, is removed from the index by a delete job. A newer upload of the same
+    # name keeps the file.
+    if job["kind"] != "upload" or _has_other_upload(job):
+        return
+    file_path = os.path.join(files_dir, job["filename"])
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    enqueue_job("delete", job["filename"], coalesce=True)
+
+
+def _run_job(job):
+    from chatbot import update_vector_store  # Lazy import to avoid circular dependency
+
+    job_id = job["id"]
+    progress = {}
+
+    def report(stage, done, total):
+        progress[stage] = {"done": done, "total": total}
+        _update_job(job_id, stage=stage, progress=progress)
+
+    def check_cancel():
+        if _cancel_requested(job_id):
+            raise IngestionCancelled(f"Job {job_id} was cancelled")
+
+    try:
+        check_cancel()
+        # glob.escape keeps names with wildcard characters literal
+        include = None if job["kind"] == "reconcile" else [glob.escape(job["filename"])]
+        summary = update_vector_store(progress=report, check_cancel=check_cancel, include=include)
+        if summary["failed"]:
+            # Files that could not be indexed, the job still completes for the others
+            progress["failed_files"] = summary["failed"]
+        if job["kind"] == "upload" and job["filename"] in summary["failed"]:
+            _discard_upload(job)
+            _update_job(job_id, status=FAILED, error=summary["failed"][job["filename"]], progress=progress)
+            print(f"\nIngestion job {job_id} failed: {summary['failed'][job['filename']]}")
+            return
+        _update_job(job_id, status=COMPLETED, stage="done", progress=progress)
+    except IngestionCancelled:
+        _discard_upload(job)
+        _update_job(job_id, status=CANCELLED)
+        print(f"\nIngestion job {job_id} cancelled")
+    except Exception as e:
+        _discard_upload(job)
+        _update_job(job_id, status=FAILED, error=str(e))
+        print(f"\nIngestion job {job_id} failed: {str(e)}")
+
+
+def _has_queued_job():
+    with _db_lock:
+        row = _conn.execute("SELECT 1 FROM ingest_jobs WHERE status = ? LIMIT 1", (QUEUED,)).fetchone()
+    return row is not None
+
+
+def _requeue_interrupted():
+    # Jobs only run under the index lock, so while holding it a job still marked as
+    # running was interrupted by a restart. It is picked up again.
+    with _db_lock:
+        _conn.execute(
+            "UPDATE ingest_jobs SET status = ?, updated_at = ? WHERE status = ?", (QUEUED, time.time(), RUNNING)
+        )
+        _conn.commit()
+
+
+def _worker_loop():
+    while True:
+        with index_lock():
+            _requeue_interrupted()
+            job = _next_job()
+            if job is not None:
+                print(f"\nRunning ingestion job {job['id']} ({job['kind']} {job['filename']})")
+                _run_job(job)
+                continue
+        while not _has_queued_job():
+            _wakeup.wait(INGEST_POLL_INTERVAL)
+            _wakeup.clear()
+
+
+def start_worker():
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    _worker = threading.Thread(target=_worker_loop, name="ingest-worker", daemon=True)
+    _worker.start()
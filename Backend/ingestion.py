@@ -0,0 +1,415 @@
+import os
+import sqlite3
+import fnmatch
+import threading
+import contextlib
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.embeddings import OllamaEmbeddings
+from concurrent.futures import FIRST_COMPLETED, wait
+from config import files_dir, db_dir, OLLAMA_BASE_URL, EMBEDDING_MODEL, VECTOR_INDEX_ENABLED, TABULAR_INGESTION_ENABLED
+from metrics import ingest_stage_seconds
+from embedding_cache import CachedEmbeddings
+from embedding_pipeline import embed_and_store, EmbeddingBatchError
+from captioning import Captioner
+from loaders import iter_loaded_files, is_supported
+import sparse_index
+import tabular_store
+import vector_index as vector_store
+from retrieval import vector_index, load_vector_index, mark_synced
+from manifest import (
+    open_manifest, list_indexed_files, referenced_chunks, update_file_stat, rename_file, remove_file, set_file,
+    write_journal, clear_journal, recover_journal, file_sha256, chunk_hash, file_entry, is_unchanged,
+    index_lock, get_collection_version, bump_collection_version, list_failed_files, set_failed_file,
+    clear_failed_file,
+)
+
+# Set the environment variable to disable anonymized telemetry for Chroma
+os.environ["ANONYMIZED_TELEMETRY"] = "False"
+
+# Indexing of the files under files_dir into the vector store, the manifest, the
+# keyword index and the table store. Used by the server (at startup and by the
+# ingestion worker) and by the bulk ingestion command, see ingest_cli.py.
+
+persistent_directory = os.path.join(db_dir, "chroma_db_with_metadata")
+
+# One cached embeddings client shared by ingestion and the retriever, see embedding_cache.py
+embeddings = CachedEmbeddings(OllamaEmbeddings(base_url=OLLAMA_BASE_URL, model=EMBEDDING_MODEL), EMBEDDING_MODEL)
+
+# Created on first use, only images without OCR text need it
+captioner = None
+
+# The Chroma vector store, opened on first use by retrieval or `update_vector_store`
+db = None
+# Collection version the open store has seen. A Chroma client does not see writes made
+# by other processes after it was opened, so it is reopened before the next write.
+db_version = None
+_open_lock = threading.Lock()
+
+class IngestionCancelled(Exception):
+    # Raised by `check_cancel` to stop an update at the next checkpoint
+    pass
+
+def get_captioner():
+    global captioner
+    if captioner is None:
+        captioner = Captioner()
+    return captioner
+
+def open_vector_store(current_version=None):
+    # Also loads the in-process vector index, so the first caller pays for both. Pass
+    # the `current_version` of the collection to reopen a store that is out of date.
+    global db, db_version
+    with _open_lock:
+        if db is not None and current_version is not None and current_version != db_version:
+            print("\nReopening the vector store, it was changed by another process")
+            db._client.clear_system_cache()
+            db = None
+        if db is None:
+            from langchain_chroma import Chroma
+
+            if os.path.exists(persistent_directory):
+                print("\nLoading existing vector store")
+            else:
+                print("\nCreating new vector store")
+            if current_version is None:
+                conn = open_manifest()
+                try:
+                    current_version = get_collection_version(conn)
+                finally:
+                    conn.close()
+            db = Chroma(embedding_function=embeddings, persist_directory=persistent_directory)
+            db_version = current_version
+    if VECTOR_INDEX_ENABLED:
+        load_vector_index()
+    return db
+
+def _applied(version, vector_index_updated=True):
+    # Records a change this process committed as `version` and applied to its own state
+    global db_version
+    if db_version == version - 1:
+        db_version = version
+    if vector_index_updated:
+        mark_synced(version - 1, version)
+
+def list_source_files(root=files_dir, include=None, exclude=None):
+    # Supported files anywhere under `root`, as paths relative to it with forward
+    # slashes. These paths are the sources recorded in the manifest. `include` and
+    # `exclude` are glob patterns matched against the relative path.
+    sources = []
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories[:] = sorted(d for d in subdirectories if not d.startswith("."))
+        for filename in sorted(filenames):
+            if filename.startswith(".") or not is_supported(filename):
+                continue
+            source = os.path.relpath(os.path.join(directory, filename), root).replace(os.sep, "/")
+            if matches_globs(source, include, exclude):
+                sources.append(source)
+    return sources
+
+def matches_globs(source, include=None, exclude=None):
+    if include and not any(fnmatch.fnmatch(source, pattern) for pattern in include):
+        return False
+    return not (exclude and any(fnmatch.fnmatch(source, pattern) for pattern in exclude))
+
+def rename_chunk_sources(old_name, new_name):
+    # Renamed files keep their vectors, only the source metadata is rewritten
+    existing = db.get(where={"source": old_name}, include=["metadatas"])
+    if not existing["ids"]:
+        return
+    metadatas = [dict(meta, source=new_name) for meta in existing["metadatas"]]
+    db._collection.update(ids=existing["ids"], metadatas=metadatas)
+
+def update_vector_store(progress=None, check_cancel=None, on_change=None, include=None, exclude=None, dry_run=False):
+    # `progress(stage, done, total)` and `check_cancel()` are supplied by the ingestion
+    # worker so job status can be reported and a cancelled job stops at a checkpoint.
+    # `on_change(sources)` is called before the index of the given files changes.
+    # With `include`/`exclude` globs only the matching files are added, updated or
+    # removed. A dry run only reports what would change and writes nothing. Returns
+    # counts of the work done.
+    # Only one process changes the index at a time, see `index_lock`
+    with contextlib.nullcontext() if dry_run else index_lock():
+        return _update_vector_store(progress, check_cancel, on_change, include, exclude, dry_run)
+
+def _update_vector_store(progress, check_cancel, on_change, include, exclude, dry_run):
+    # `failed` maps files that could not be indexed to their error
+    summary = {"files": 0, "renamed": 0, "deleted": 0, "chunks": 0, "embedded": 0, "failed": {}}
+    # Futures of image captions still being made, with their files
+    pending_captions = {}
+
+    def changed(sources):
+        if on_change is not None:
+            on_change(sources)
+
+    def report(stage, done, total):
+        if progress is not None:
+            progress(stage, done, total)
+
+    def checkpoint():
+        if check_cancel is not None:
+            check_cancel()
+
+    conn = open_manifest(read_only=dry_run)
+    db = None
+    try:
+        indexed_files = list_indexed_files(conn)
+        failed_files = list_failed_files(conn)
+
+        # List all files under the files directory
+        all_files = list_source_files(files_dir, include, exclude)
+
+        if not dry_run:
+            db = open_vector_store(get_collection_version(conn))
+
+            # Roll back whatever an interrupted run left uncommitted
+            vector_index.remove(recover_journal(db, conn))
+            tabular_store.recover_staged(indexed_files)
+            # Copy what earlier versions only stored in Chroma
+            added_texts = sparse_index.backfill(db, conn)
+            added_vectors = vector_store.backfill(db, conn)
+            if added_vectors or added_texts:
+                with conn:
+                    version = bump_collection_version(conn)
+                    vector_store.log_changes(conn, version, added_vectors, [])
+                _applied(version, vector_index_updated=False)
+
+        # Spreadsheets indexed row by row by earlier versions are loaded into tables
+        table_sources = tabular_store.indexed_sources() if TABULAR_INGESTION_ENABLED else None
+
+        # Identify new and changed files by content: size and mtime first, then SHA-256
+        changed_files = {}
+        for index, file in enumerate(all_files):
+            checkpoint()
+            report("scan", index, len(all_files))
+            file_path = os.path.join(files_dir, file)
+            entry = indexed_files.get(file)
+            if table_sources is not None and tabular_store.is_tabular(file) and file not in table_sources:
+                entry = None
+            if entry is not None and is_unchanged(entry, file_path):
+                continue
+            # Files that failed are retried once their content changes
+            failure = failed_files.get(file)
+            if failure is not None and is_unchanged(failure, file_path):
+                continue
+            digest = file_sha256(file_path)
+            if entry is not None and entry["sha256"] == digest:
+                # Touched but not modified, only refresh the fast path fields
+                if not dry_run:
+                    with conn:
+                        update_file_stat(conn, file, file_entry(file_path, digest))
+                continue
+            if failure is not None and failure["sha256"] == digest:
+                continue
+            changed_files[file] = digest
+        report("scan", len(all_files), len(all_files))
+
+        # Identify deleted files, among those the globs select
+        all_files_set = set(all_files)
+        deleted_files = [
+            f for f in indexed_files if f not in all_files_set and matches_globs(f, include, exclude)
+        ]
+        if not dry_run:
+            with conn:
+                for file in failed_files:
+                    if file not in all_files_set and matches_globs(file, include, exclude):
+                        clear_failed_file(conn, file)
+            # Tables of files the manifest does not record, e.g. left by earlier versions
+            # when indexing a spreadsheet failed after its tables were loaded
+            for source in table_sources or ():
+                if source not in indexed_files and matches_globs(source, include, exclude):
+                    tabular_store.remove_source(source)
+
+        # A new file with the same content as a deleted one is a rename and keeps its chunks
+        deleted_by_hash = {indexed_files[f]["sha256"]: f for f in deleted_files}
+        for file, digest in list(changed_files.items()):
+            old_name = deleted_by_hash.pop(digest, None)
+            if old_name is None or file in indexed_files:
+                continue
+            print(f"\nRenamed file detected: {old_name} -> {file}")
+            summary["renamed"] += 1
+            deleted_files.remove(old_name)
+            del changed_files[file]
+            if dry_run:
+                continue
+            rename_chunk_sources(old_name, file)
+            tabular_store.rename_source(old_name, file)
+            changed([old_name])
+            with conn:
+                rename_file(conn, old_name, file, file_entry(os.path.join(files_dir, file), digest))
+                version = bump_collection_version(conn)
+            _applied(version)
+
+        summary["files"] = len(changed_files)
+        summary["deleted"] = len(deleted_files)
+        if not changed_files and not deleted_files:
+            print("\nNo changes detected in files.")
+            return summary
+
+        if dry_run:
+            print(f"\nNew or changed files: {list(changed_files)}")
+            print(f"Deleted files: {deleted_files}")
+            return summary
+
+        def add_file(file, entry, chunk_ids, new_chunks):
+            orphaned = set_file(conn, file, entry, chunk_ids)
+            sparse_index.add_chunks(conn, [(chunk_id, chunk.page_content) for chunk_id, chunk in new_chunks.items()])
+            return orphaned
+
+        def commit(file, update, new_vectors):
+            # Journal the chunk ids, commit the manifest and swap in the file's staged
+            # tables, then drop vectors whose last referencing file went away. See `recover_journal` for the crash cases.
+            # `new_vectors` maps the chunks added to Chroma for this file to their vectors.
+            changed([file])
+            new_chunk_ids = list(new_vectors)
+            with conn:
+                ids_to_delete = update()
+                sparse_index.remove_chunks(conn, ids_to_delete)
+                vector_store.remove_vectors(conn, ids_to_delete)
+                vector_store.store_vectors(conn, list(new_vectors.items()))
+                write_journal(new_chunk_ids + ids_to_delete)
+                version = bump_collection_version(conn)
+                vector_store.log_changes(conn, version, new_chunk_ids, ids_to_delete)
+            if tabular_store.is_tabular(file):
+                tabular_store.publish_source(file)
+            vector_index.add(new_chunk_ids, list(new_vectors.values()))
+            if ids_to_delete:
+                print(f"\nDeleting {len(ids_to_delete)} vectors no longer referenced by any file")
+                db.delete(ids_to_delete)
+                vector_index.remove(ids_to_delete)
+            clear_journal()
+            _applied(version)
+
+        if deleted_files:
+            print(f"\nDeleted files detected: {deleted_files}")
+            for index, file in enumerate(deleted_files):
+                checkpoint()
+                report("delete", index, len(deleted_files))
+                commit(file, lambda: remove_file(conn, file), {})
+                tabular_store.remove_source(file)
+            report("delete", len(deleted_files), len(deleted_files))
+
+        # Process new and changed files, each one committed on its own so an
+        # interrupted run resumes after the last committed file
+        if changed_files:
+            print(f"\nNew or changed files detected: {list(changed_files)}")
+
+            rec_char_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=1000, chunk_overlap=100
+            )
+
+            def index_file(file, documents):
+                print(f"Loaded {len(documents)} documents from {file}")
+
+                chunks = {}
+                with ingest_stage_seconds.time("split"):
+                    for chunk in rec_char_splitter.split_documents(documents):
+                        chunk_id = chunk_hash(chunk.page_content)
+                        if chunk_id not in chunks:
+                            chunk.metadata = {"source": file, "chunk_id": chunk_id}
+                            chunks[chunk_id] = chunk
+                chunk_ids = list(chunks)
+                summary["chunks"] += len(chunk_ids)
+                report("split", summary["chunks"], summary["chunks"])
+
+                # Only chunks that are not already stored for another file need embedding
+                stored = referenced_chunks(conn, chunk_ids)
+                new_chunks = {chunk_id: chunk for chunk_id, chunk in chunks.items() if chunk_id not in stored}
+
+                write_journal(list(new_chunks))
+                new_vectors = {}
+                if new_chunks:
+                    checkpoint()
+                    print(f"Adding {len(new_chunks)} new document chunks from {file} to the vector store")
+                    with ingest_stage_seconds.time("embed"):
+                        embed_and_store(
+                            db, embeddings, list(new_chunks.values()), list(new_chunks),
+                            progress=progress, check_cancel=check_cancel,
+                            on_batch=lambda ids, vectors: new_vectors.update(zip(ids, vectors)),
+                        )
+                    summary["embedded"] += len(new_chunks)
+
+                entry = file_entry(os.path.join(files_dir, file), changed_files[file])
+                with ingest_stage_seconds.time("persist"):
+                    commit(file, lambda: add_file(file, entry, chunk_ids, new_chunks), new_vectors)
+
+            def fail(file, error):
+                # Rolls back what was stored for the file and records it as failed, so
+                # the run carries on and later runs skip it until its content changes
+                print(f"\nFailed to index {file}: {str(error)}")
+                vector_index.remove(recover_journal(db, conn))
+                if tabular_store.is_tabular(file):
+                    tabular_store.discard_staged(file)
+                summary["failed"][file] = str(error)
+                with conn:
+                    set_failed_file(conn, file, file_entry(os.path.join(files_dir, file), changed_files[file]), str(error))
+                report("failed", len(summary["failed"]), len(changed_files))
+
+            def try_index_file(file, documents):
+                # Embedding and database errors are not the file's fault and stop the run
+                try:
+                    index_file(file, documents)
+                except (IngestionCancelled, EmbeddingBatchError, sqlite3.Error):
+                    raise
+                except Exception as e:
+                    fail(file, e)
+
+            def index_captioned(block):
+                # Indexes the images whose captions are ready, waiting for one if `block`
+                if block and pending_captions:
+                    wait(pending_captions, return_when=FIRST_COMPLETED)
+                for future in [future for future in pending_captions if future.done()]:
+                    checkpoint()
+                    file = pending_captions.pop(future)
+                    try:
+                        documents = future.result()
+                    except Exception as e:
+                        fail(file, e)
+                        continue
+                    try_index_file(file, documents)
+
+            # Files stream through loading, splitting and embedding one at a time,
+            # so only the files currently in flight are held in memory. Images without
+            # OCR text are captioned in the background meanwhile, see captioning.py.
+            loaded_files = iter_loaded_files(list(changed_files), check_cancel=check_cancel)
+            for index, (file, documents, load_seconds, error) in enumerate(loaded_files):
+                checkpoint()
+                report("load", index + 1, len(changed_files))
+                if error is not None:
+                    fail(file, error)
+                    continue
+                is_image = file.lower().endswith((".png", ".jpg", ".jpeg"))
+                # Loading an image is its OCR pass
+                ingest_stage_seconds.observe("ocr" if is_image else "load", load_seconds)
+                if not documents and is_image:
+                    print(f"No OCR text detected in image file: {file}. Using model for description.")
+                    captions = get_captioner()
+                    future = captions.submit(os.path.join(files_dir, file), file, changed_files[file])
+                    pending_captions[future] = file
+                    index_captioned(block=len(pending_captions) >= 2 * captions.concurrency)
+                    continue
+                try_index_file(file, documents)
+                index_captioned(block=False)
+            while pending_captions:
+                index_captioned(block=True)
+
+            print("\nDocument Chunks Information")
+            print(f"Number of document chunks: {summary['chunks']}")
+            print(f"Number of new chunks embedded: {summary['embedded']}")
+            if summary["failed"]:
+                print(f"Files that could not be indexed: {list(summary['failed'])}")
+
+        print("\nFinished updating vector store")
+        return summary
+
+    except Exception as e:
+        # Files committed so far stay indexed, only the file in progress is rolled back
+        if isinstance(e, IngestionCancelled):
+            print("\nIngestion cancelled")
+        else:
+            print(f"\nAn error occurred: {str(e)}")
+        for future in pending_captions:
+            future.cancel()
+        if db is not None:
+            vector_index.remove(recover_journal(db, conn))
+        raise
+    finally:
+        conn.close()
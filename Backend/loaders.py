@@ -0,0 +1,140 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from langchain_community.document_loaders import PyPDFLoader, CSVLoader, UnstructuredExcelLoader, JSONLoader, UnstructuredImageLoader
+from langchain_core.documents import Document
+import tabular_store
+from config import files_dir, LOADER_WORKERS, LOADER_MAX_IN_FLIGHT, TABULAR_INGESTION_ENABLED
+
+# Registry of document loaders by file extension. Loaders are plain module level
+# functions taking (file_path, filename) and returning a list of Documents, so they can
+# run in worker processes. Register new file types with `register_loader`.
+
+LOADERS = {}
+
+
+def register_loader(extensions, loader):
+    for extension in extensions:
+        LOADERS[extension.lower()] = loader
+
+
+def supported_extensions():
+    return tuple(LOADERS)
+
+
+def is_supported(filename):
+    return os.path.splitext(filename)[1].lower() in LOADERS
+
+
+def _with_source(documents, filename):
+    for doc in documents:
+        doc.metadata = {"source": filename}
+    return documents
+
+
+def load_pdf(file_path, filename):
+    return _with_source(PyPDFLoader(file_path).load(), filename)
+
+
+def load_table(file_path, filename):
+    # The rows go into the table store, only the table descriptions are embedded
+    return [
+        Document(page_content=description, metadata={"source": filename})
+        for description in tabular_store.ingest_file(file_path, filename)
+    ]
+
+
+def load_csv(file_path, filename):
+    if TABULAR_INGESTION_ENABLED:
+        return load_table(file_path, filename)
+    return _with_source(CSVLoader(file_path, csv_args={'delimiter': ','}).load(), filename)
+
+
+def load_excel(file_path, filename):
+    if TABULAR_INGESTION_ENABLED:
+        return load_table(file_path, filename)
+    return _with_source(UnstructuredExcelLoader(file_path).load(), filename)
+
+
+def load_json(file_path, filename):
+    loader = JSONLoader(file_path, text_content=False, jq_schema=".[]")
+    # loader = JSONLoader(file_path, text_content=False, jq_schema=".")
+    return _with_source(loader.load(), filename)
+
+
+def load_image(file_path, filename):
+    # Only OCR text is extracted here. Images without text come back empty and are
+    # described by the image model in the main process.
+    image_docs = UnstructuredImageLoader(file_path).load()
+    return _with_source([doc for doc in image_docs if doc.page_content.strip()], filename)
+
+
+register_loader([".pdf"], load_pdf)
+register_loader([".csv"], load_csv)
+register_loader([".xlsx"], load_excel)
+register_loader([".json"], load_json)
+register_loader([".jpg", ".jpeg", ".png"], load_image)
+
+
+def load_file(filename):
+    loader = LOADERS[os.path.splitext(filename)[1].lower()]
+    return loader(os.path.join(files_dir, filename), filename)
+
+
+def _timed_load_file(filename):
+    start = time.perf_counter()
+    documents = load_file(filename)
+    return documents, time.perf_counter() - start
+
+
+def iter_loaded_files(filenames, workers=LOADER_WORKERS, max_in_flight=LOADER_MAX_IN_FLIGHT, check_cancel=None):
+    # Yields (filename, documents, seconds spent loading, error) as files finish loading.
+    # A file that fails to load comes back with no documents and the exception, so one
+    # bad file does not stop the others. At most `max_in_flight` files are parsed or
+    # waiting to be consumed at any time, which bounds memory regardless of how many
+    # files are ingested.
+    if workers <= 1:
+        for filename in filenames:
+            if check_cancel is not None:
+                check_cancel()
+            try:
+                documents, seconds = _timed_load_file(filename)
+            except Exception as e:
+                yield (filename, None, 0.0, e)
+                continue
+            yield (filename, documents, seconds, None)
+        return
+
+    # Spawned workers do not inherit the server's threads and locks
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        remaining = iter(filenames)
+        pending = {}
+        try:
+            while True:
+                while len(pending) < max_in_flight:
+                    filename = next(remaining, None)
+                    if filename is None:
+                        break
+                    pending[executor.submit(_timed_load_file, filename)] = filename
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename = pending.pop(future)
+                    try:
+                        documents, seconds = future.result()
+                    except BrokenProcessPool:
+                        # A crashed worker fails every pending file, not just this one
+                        raise
+                    except Exception as e:
+                        yield (filename, None, 0.0, e)
+                        continue
+                    yield (filename, documents, seconds, None)
+                if check_cancel is not None:
+                    check_cancel()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import fcntl
+import random
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+import sparse_index
+import vector_index
+from config import files_dir, db_dir
+
+# The manifest records what has been indexed, keyed by content rather than filename.
+# It is a SQLite database with these tables:
+#   files:        filename -> size, mtime, sha256
+#   file_chunks:  (source, chunk_id) pairs, indexed both ways
+#   failed_files: filename -> size, mtime, sha256 and error of files that could not be
+#                 indexed, skipped until their content changes
+# Chunk ids are the SHA-256 of the chunk text, so identical chunks across files are
+# stored and embedded once. A chunk's reference count is the number of files listing
+# it, and its vector is removed when the last one goes. Every lookup, update and
+# delete touches only the rows of the file involved. The keyword index over the chunk
+# texts lives in the same database, see sparse_index.py.
+
+manifest_db_file = os.path.join(db_dir, "manifest.sqlite3")
+
+# Write-ahead journal of the chunk ids touched by the ingestion step in progress,
+# see `recover_journal`
+journal_file = os.path.join(db_dir, "ingest_journal.json")
+
+# Held while the index is being changed, so only one process ingests at a time, see `index_lock`
+index_lock_file = os.path.join(db_dir, "index.lock")
+
+_lock_state = threading.local()
+
+# Files written by earlier versions, imported into the database on first open
+json_manifest_file = os.path.join(db_dir, "manifest.json")
+legacy_processed_files_file = os.path.join(db_dir, "processed_files.json")
+legacy_metadata_file = os.path.join(db_dir, "metadata.json")
+
+
+def atomic_write_json(path, data):
+    # Write to a temporary file in the same directory and rename it over the target,
+    # so a crash never leaves a half written file behind
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@contextmanager
+def index_lock():
+    # Exclusive lock across processes, e.g. uvicorn workers and the ingestion command.
+    # Reentrant within a thread.
+    depth = getattr(_lock_state, "depth", 0)
+    if depth:
+        _lock_state.depth = depth + 1
+        try:
+            yield
+        finally:
+            _lock_state.depth -= 1
+        return
+
+    os.makedirs(db_dir, exist_ok=True)
+    with open(index_lock_file, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        _lock_state.depth = 1
+        try:
+            yield
+        finally:
+            _lock_state.depth = 0
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_entry(file_path, sha256):
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+
+
+def is_unchanged(entry, file_path):
+    # Fast path: same size and modification time means the content was not touched
+    stat = os.stat(file_path)
+    return entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+
+
+def _legacy_manifest():
+    # Files indexed by filename only keep their existing (uuid) chunks, so upgrading
+    # does not re-embed anything. Files that have since disappeared get an empty hash
+    # and are cleaned up as deletions on the next update.
+    with open(legacy_processed_files_file, "r") as file:
+        processed_files = json.load(file)
+    metadata = {}
+    if os.path.exists(legacy_metadata_file):
+        with open(legacy_metadata_file, "r") as file:
+            metadata = json.load(file)
+
+    chunks_by_source = {}
+    for chunk_id, source in metadata.items():
+        chunks_by_source.setdefault(source, []).append(chunk_id)
+
+    files = {}
+    for filename in processed_files:
+        file_path = os.path.join(files_dir, filename)
+        if os.path.exists(file_path):
+            files[filename] = file_entry(file_path, file_sha256(file_path))
+        else:
+            files[filename] = {"size": -1, "mtime": 0, "sha256": ""}
+        files[filename]["chunks"] = chunks_by_source.get(filename, [])
+    return files
+
+
+def _import_files(conn, remove_old_files=True):
+    if os.path.exists(json_manifest_file):
+        with open(json_manifest_file, "r") as file:
+            files = json.load(file)["files"]
+    elif os.path.exists(legacy_processed_files_file):
+        files = _legacy_manifest()
+    else:
+        return
+
+    with conn:
+        for filename, entry in files.items():
+            conn.execute(
+                "INSERT OR REPLACE INTO files (name, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                (filename, entry["size"], entry["mtime"], entry["sha256"]),
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO file_chunks (source, chunk_id, position) VALUES (?, ?, ?)",
+                [(filename, chunk_id, position) for position, chunk_id in enumerate(entry["chunks"])],
+            )
+    if not remove_old_files:
+        return
+    for old_file in (json_manifest_file, legacy_processed_files_file, legacy_metadata_file):
+        if os.path.exists(old_file):
+            os.remove(old_file)
+    print(f"\nImported {len(files)} indexed files into the manifest database")
+
+
+def open_manifest(read_only=False):
+    if read_only:
+        return _open_read_only()
+    os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(manifest_db_file, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    _create_tables(conn)
+    conn.commit()
+    _import_files(conn)
+    return conn
+
+
+def _open_read_only():
+    # For dry runs: nothing on disk is created, migrated or removed. The file lists of
+    # the manifest, which is all a dry run reads, are copied into an in-memory database,
+    # together with a legacy JSON manifest that has not been imported yet.
+    conn = sqlite3.connect("file::memory:", uri=True)
+    _create_tables(conn)
+    if os.path.exists(manifest_db_file):
+        conn.execute("ATTACH DATABASE ? AS stored", (f"file:{manifest_db_file}?mode=ro",))
+        stored = {name for (name,) in conn.execute("SELECT name FROM stored.sqlite_master WHERE type = 'table'")}
+        for table in ("files", "failed_files"):
+            if table not in stored:
+                continue
+            columns = [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+            present = {row[1] for row in conn.execute(f"PRAGMA stored.table_info({table})")}
+            names = ", ".join(column for column in columns if column in present)
+            conn.execute(f"INSERT INTO main.{table} ({names}) SELECT {names} FROM stored.{table}")
+        conn.commit()
+        conn.execute("DETACH DATABASE stored")
+    _import_files(conn, remove_old_files=False)
+    return conn
+
+
+def _create_tables(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, sha256 TEXT NOT NULL)"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS file_chunks (
+            source TEXT NOT NULL,
+            chunk_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (source, chunk_id)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_file_chunks_chunk_id ON file_chunks (chunk_id)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS failed_files (
+            name TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            sha256 TEXT NOT NULL,
+            error TEXT NOT NULL,
+            failed_at REAL NOT NULL
+        )
+        """
+    )
+    # Bumped in every transaction that changes the indexed chunks or their sources, so
+    # other processes know when their in-memory state is out of date
+    conn.execute("CREATE TABLE IF NOT EXISTS collection_state (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    # Starts at a random value, so a rebuilt database never repeats a version a running
+    # process has already seen
+    conn.execute(
+        "INSERT OR IGNORE INTO collection_state (name, value) VALUES ('version', ?)", (random.getrandbits(48),)
+    )
+    sparse_index.create_tables(conn)
+    vector_index.create_tables(conn)
+
+
+def get_collection_version(conn):
+    row = conn.execute("SELECT value FROM collection_state WHERE name = 'version'").fetchone()
+    return row[0] if row else 0
+
+
+def bump_collection_version(conn):
+    conn.execute(
+        "INSERT INTO collection_state (name, value) VALUES ('version', 1) "
+        "ON CONFLICT (name) DO UPDATE SET value = value + 1"
+    )
+    return get_collection_version(conn)
+
+
+def list_indexed_files(conn):
+    rows = conn.execute("SELECT name, size, mtime, sha256 FROM files").fetchall()
+    return {name: {"size": size, "mtime": mtime, "sha256": sha256} for name, size, mtime, sha256 in rows}
+
+
+def list_failed_files(conn):
+    rows = conn.execute("SELECT name, size, mtime, sha256, error FROM failed_files").fetchall()
+    return {
+        name: {"size": size, "mtime": mtime, "sha256": sha256, "error": error}
+        for name, size, mtime, sha256, error in rows
+    }
+
+
+def set_failed_file(conn, filename, entry, error):
+    conn.execute(
+        "INSERT OR REPLACE INTO failed_files (name, size, mtime, sha256, error, failed_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (filename, entry["size"], entry["mtime"], entry["sha256"], error, time.time()),
+    )
+
+
+def clear_failed_file(conn, filename):
+    conn.execute("DELETE FROM failed_files WHERE name = ?", (filename,))
+
+
+def get_file_chunks(conn, filename):
+    rows = conn.execute(
+        "SELECT chunk_id FROM file_chunks WHERE source = ? ORDER BY position", (filename,)
+    ).fetchall()
+    return [chunk_id for (chunk_id,) in rows]
+
+
+def get_chunk_positions(conn, chunk_ids):
+    # Returns {(source, chunk_id): position of the chunk in that file}
+    positions = {}
+    for start in range(0, len(chunk_ids), 500):
+        batch = chunk_ids[start:start + 500]
+        placeholders = ",".join("?" * len(batch))
+        rows = conn.execute(
+            f"SELECT source, chunk_id, position FROM file_chunks WHERE chunk_id IN ({placeholders})", batch
+        ).fetchall()
+        positions.update(((source, chunk_id), position) for source, chunk_id, position in rows)
+    return positions
+
+
+def referenced_chunks(conn, chunk_ids):
+    referenced = set()
+    for start in range(0, len(chunk_ids), 500):
+        batch = chunk_ids[start:start + 500]
+        placeholders = ",".join("?" * len(batch))
+        rows = conn.execute(
+            f"SELECT DISTINCT chunk_id FROM file_chunks WHERE chunk_id IN ({placeholders})", batch
+        ).fetchall()
+        referenced.update(chunk_id for (chunk_id,) in rows)
+    return referenced
+
+
+def count_chunks(conn):
+    return conn.execute("SELECT COUNT(DISTINCT chunk_id) FROM file_chunks").fetchone()[0]
+
+
+def update_file_stat(conn, filename, entry):
+    conn.execute(
+        "UPDATE files SET size = ?, mtime = ?, sha256 = ? WHERE name = ?",
+        (entry["size"], entry["mtime"], entry["sha256"], filename),
+    )
+
+
+def rename_file(conn, old_name, new_name, entry):
+    conn.execute("DELETE FROM files WHERE name = ?", (old_name,))
+    conn.execute(
+        "INSERT OR REPLACE INTO files (name, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+        (new_name, entry["size"], entry["mtime"], entry["sha256"]),
+    )
+    conn.execute("UPDATE file_chunks SET source = ? WHERE source = ?", (new_name, old_name))
+
+
+def remove_file(conn, filename):
+    # Returns the chunks no other file references any more
+    released = get_file_chunks(conn, filename)
+    conn.execute("DELETE FROM files WHERE name = ?", (filename,))
+    conn.execute("DELETE FROM file_chunks WHERE source = ?", (filename,))
+    still_referenced = referenced_chunks(conn, released)
+    return [chunk_id for chunk_id in released if chunk_id not in still_referenced]
+
+
+def set_file(conn, filename, entry, chunk_ids):
+    # Replaces the file's chunk list and returns chunks of its previous version that
+    # no file references any more
+    orphaned = remove_file(conn, filename)
+    clear_failed_file(conn, filename)
+    conn.execute(
+        "INSERT INTO files (name, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+        (filename, entry["size"], entry["mtime"], entry["sha256"]),
+    )
+    conn.executemany(
+        "INSERT INTO file_chunks (source, chunk_id, position) VALUES (?, ?, ?)",
+        [(filename, chunk_id, position) for position, chunk_id in enumerate(chunk_ids)],
+    )
+    kept = set(chunk_ids)
+    return [chunk_id for chunk_id in orphaned if chunk_id not in kept]
+
+
+def write_journal(chunk_ids):
+    atomic_write_json(journal_file, {"chunk_ids": chunk_ids})
+
+
+def clear_journal():
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
+
+
+def recover_journal(db, conn):
+    # Every step that writes to or deletes from the vector store first journals the
+    # chunk ids involved, then commits the manifest, then clears the journal. Whatever
+    # step was interrupted, the journalled ids the committed manifest does not reference
+    # are either uncommitted additions or committed deletions, and can be removed.
+    # Returns the removed ids.
+    if not os.path.exists(journal_file):
+        return []
+    with open(journal_file, "r") as file:
+        chunk_ids = json.load(file)["chunk_ids"]
+    referenced = referenced_chunks(conn, chunk_ids)
+    unreferenced = [chunk_id for chunk_id in chunk_ids if chunk_id not in referenced]
+    if unreferenced:
+        print(f"\nRolling back {len(unreferenced)} uncommitted chunks from an interrupted ingestion")
+        db.delete(unreferenced)
+    clear_journal()
+    return unreferenced
@@ -0,0 +1,111 @@
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from config import TRACE_REQUESTS
+
+# Latency histograms for the RAG pipeline and ingestion, exported in the Prometheus
+# text format by the /metrics endpoint. Kept dependency free on purpose.
+
+logger = logging.getLogger("rag.metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Histogram:
+    def __init__(self, name, description, label_name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label value -> [bucket counts..., +Inf count], sum
+        self._series = {}
+
+    def observe(self, label, seconds):
+        with self._lock:
+            counts, total = self._series.get(label, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self._series[label] = (counts, total + seconds)
+
+    @contextmanager
+    def time(self, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(label, time.perf_counter() - start)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{self.label_name}="{label}",le="{bound}"}} {cumulative}')
+                cumulative += counts[-1]
+                lines.append(f'{self.name}_bucket{{{self.label_name}="{label}",le="+Inf"}} {cumulative}')
+                lines.append(f'{self.name}_sum{{{self.label_name}="{label}"}} {total}')
+                lines.append(f'{self.name}_count{{{self.label_name}="{label}"}} {cumulative}')
+        return "\n".join(lines)
+
+
+chat_stage_seconds = Histogram(
+    "rag_chat_stage_seconds", "Duration of /chat pipeline stages in seconds", "stage"
+)
+ingest_stage_seconds = Histogram(
+    "rag_ingest_stage_seconds", "Duration of ingestion stages in seconds, per file or batch", "stage"
+)
+
+audio_stage_seconds = Histogram(
+    "rag_audio_stage_seconds", "Duration of audio decoding and transcription in seconds", "stage"
+)
+
+
+class Trace:
+    # Collects the spans of one request. Each span is also recorded in `histogram`,
+    # and the whole trace is logged as one JSON line when TRACE_REQUESTS is enabled.
+
+    def __init__(self, histogram, name, **attributes):
+        self.histogram = histogram
+        self.name = name
+        self.attributes = attributes
+        self.spans = {}
+        self.start = time.perf_counter()
+
+    def record(self, stage, seconds):
+        self.spans[stage] = round(self.spans.get(stage, 0.0) + seconds, 6)
+        self.histogram.observe(stage, seconds)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def since_start(self):
+        return time.perf_counter() - self.start
+
+    def finish(self):
+        self.record("total", self.since_start())
+        if TRACE_REQUESTS:
+            logger.info(json.dumps({"trace": self.name, **self.attributes, "spans": self.spans}))
+
+
+def gauge(name, description, value):
+    return f"# HELP {name} {description}\n# TYPE {name} gauge\n{name} {value}"
+
+
+def counter(name, description, value):
+    # `name` ends in _total, as Prometheus expects of counters
+    return f"# HELP {name} {description}\n# TYPE {name} counter\n{name} {value}"
+
+
+def render_metrics(extra=()):
+    sections = [chat_stage_seconds.render(), ingest_stage_seconds.render(), audio_stage_seconds.render(), *extra]
+    return "\n".join(sections) + "\n"
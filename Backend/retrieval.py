@@ -0,0 +1,160 @@
+import threading
+from langchain_core.documents import Document
+import sparse_index
+from manifest import open_manifest, get_file_chunks, get_chunk_positions, get_collection_version
+from vector_index import VectorIndex
+from config import RETRIEVAL_K, HYBRID_CANDIDATES, RRF_K
+
+# Retrieval for /chat. Vector search runs on the in-process NumPy index when it is
+# loaded (see vector_index.py) and falls back to querying Chroma otherwise. Chunk texts
+# come from the keyword index, so a search does not go through Chroma at all.
+#
+# Hybrid retrieval: the nearest chunks by embedding and the best BM25 keyword matches
+# are fused with reciprocal rank fusion. Keyword matches catch the exact identifiers
+# and column values embeddings are bad at, so fewer vector candidates are needed.
+#
+# Every search can be limited to the chunks of some source files.
+
+_local = threading.local()
+
+# Updated by `update_vector_store` in this process, and by `sync_with_collection` for
+# changes made by other processes
+vector_index = VectorIndex()
+
+# Collection version (see manifest.py) the in-process state reflects
+_synced_version = None
+_sync_lock = threading.Lock()
+_change_listeners = []
+
+
+def _manifest_reader():
+    # One read connection per thread, WAL mode lets reads run alongside ingestion
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = open_manifest()
+    return conn
+
+
+def load_vector_index():
+    global _synced_version
+    with _sync_lock:
+        if vector_index.loaded:
+            return
+        conn = _manifest_reader()
+        # Read before loading, so a change committed during the load is synced later
+        version = get_collection_version(conn)
+        vector_index.load(conn)
+        _synced_version = version
+
+
+def collection_version():
+    return get_collection_version(_manifest_reader())
+
+
+def on_collection_change(listener):
+    # `listener()` is called after catching up with changes made by another process
+    _change_listeners.append(listener)
+
+
+def sync_with_collection():
+    # Called before every search. When another process, e.g. another uvicorn worker or
+    # the ingestion command, changed the indexed chunks, the vector index catches up
+    # and the listeners drop state built from the old chunks.
+    global _synced_version
+    conn = _manifest_reader()
+    version = get_collection_version(conn)
+    if version == _synced_version:
+        return
+    with _sync_lock:
+        if version == _synced_version:
+            return
+        if vector_index.loaded:
+            added, removed = vector_index.sync(conn, _synced_version, version)
+            print(f"\nSynced the retrieval index with collection version {version}: {added} added, {removed} removed")
+        _synced_version = version
+    for listener in _change_listeners:
+        listener()
+
+
+def mark_synced(previous_version, version):
+    # The process that made a change applies it to its own state directly
+    global _synced_version
+    with _sync_lock:
+        if _synced_version == previous_version:
+            _synced_version = version
+
+
+def _chunks_of(conn, sources):
+    if sources is None:
+        return None
+    return [chunk_id for source in sources for chunk_id in get_file_chunks(conn, source)]
+
+
+def _documents(conn, chunk_ids):
+    found = sparse_index.get_chunks(conn, chunk_ids)
+    return {
+        chunk_id: Document(page_content=text, metadata={"source": source, "chunk_id": chunk_id})
+        for chunk_id, (text, source) in found.items()
+    }
+
+
+def _chroma_filter(sources):
+    # Chroma only knows the first file a shared chunk was stored for
+    return None if sources is None else {"source": {"$in": list(sources)}}
+
+
+def reciprocal_rank_fusion(rankings, rrf_k=RRF_K):
+    # `rankings` are lists of ids, best first. Returns all ids by fused score.
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def vector_search(db, vector, limit, sources=None):
+    # Returns ([chunk ids], {chunk_id: Document}), nearest first. Documents may be
+    # left out and are then looked up by the caller.
+    if vector_index.loaded:
+        restrict_ids = _chunks_of(_manifest_reader(), sources)
+        return [chunk_id for chunk_id, _ in vector_index.search(vector, limit, restrict_ids)], {}
+
+    result = db._collection.query(
+        query_embeddings=[vector], n_results=limit, where=_chroma_filter(sources), include=["documents", "metadatas"]
+    )
+    ids = result["ids"][0]
+    documents = {
+        chunk_id: Document(page_content=text, metadata=dict(metadata, chunk_id=chunk_id))
+        for chunk_id, text, metadata in zip(ids, result["documents"][0], result["metadatas"][0])
+    }
+    return ids, documents
+
+
+def mmr_search(db, vector, k=RETRIEVAL_K, fetch_k=30, lambda_mult=0.5, sources=None):
+    if not vector_index.loaded:
+        return db.max_marginal_relevance_search_by_vector(
+            vector, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=_chroma_filter(sources)
+        )
+    conn = _manifest_reader()
+    selected = vector_index.max_marginal_relevance(vector, k, fetch_k, lambda_mult, _chunks_of(conn, sources))
+    documents = _documents(conn, selected)
+    return [documents[chunk_id] for chunk_id in selected if chunk_id in documents]
+
+
+def hybrid_search(db, question, vector, k=RETRIEVAL_K, candidates=HYBRID_CANDIDATES, rrf_k=RRF_K, sources=None):
+    vector_ids, documents = vector_search(db, vector, candidates, sources)
+    conn = _manifest_reader()
+    keyword_ids = sparse_index.search(conn, question, candidates, sources)
+
+    fused = reciprocal_rank_fusion([vector_ids, keyword_ids], rrf_k)[:k]
+    documents.update(_documents(conn, [chunk_id for chunk_id in fused if chunk_id not in documents]))
+    return [documents[chunk_id] for chunk_id in fused if chunk_id in documents]
+
+
+def chunk_positions(chunk_ids):
+    # {(source, chunk_id): position in the file}, for merging neighbouring chunks
+    return get_chunk_positions(_manifest_reader(), chunk_ids)
+
+
+def query_term_weights(question):
+    return sparse_index.term_weights(_manifest_reader(), question)
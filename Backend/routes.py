@@ -1,55 +1,42 @@
 import os
-import json
+import asyncio
 import uuid
 import shutil
-import whisper
+import time
 from fastapi import HTTPException, Path, Request, UploadFile, File, WebSocket, WebSocketDisconnect, APIRouter
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from collections import defaultdict
 from langchain_core.messages import HumanMessage, SystemMessage
-
-current_dir = os.path.dirname(os.path.abspath(__file__))
-chat_sessions_dir = os.path.join(current_dir, "chat_sessions")
-files_dir = os.path.join(current_dir, "files")
-
-if not os.path.exists(chat_sessions_dir):
-    os.makedirs(chat_sessions_dir)
-
-# Initialize openai-whisper model
-whisper_model = whisper.load_model("base")
-
-# Store session titles
-session_titles = defaultdict(str)
+from config import files_dir, TITLE_MODEL, TRANSCRIBE_PARTIAL_INTERVAL, AUDIO_MAX_BYTES
+import session_store
+from chat_memory import load_prompt_history, schedule_summary_update
+from metrics import render_metrics, gauge, counter
+from ingest_jobs import enqueue_job, get_job, list_jobs, request_cancel, FINISHED_STATES
+from transcription import StreamingTranscript
+from ingestion import list_source_files
 
 # Router instance
 router = APIRouter()
 
-# Function to load chat history from a file
+# Function to load chat history from the session store
 def load_chat_history(session_id):
-    session_file = os.path.join(chat_sessions_dir, f"{session_id}.json")
-    if os.path.exists(session_file):
-        with open(session_file, "r") as file:
-            session_data = json.load(file)
-            session_titles[session_id] = session_data.get("title", session_titles.get(session_id, "Untitled Session"))
-            return [
-                HumanMessage(content=msg["content"]) if msg["type"] == "human" else SystemMessage(content=msg["content"])
-                for msg in session_data.get("history", [])
-            ]
-    return []
-
-# Function to save chat history to a file
-def save_chat_history(session_id, chat_history):
-    session_file = os.path.join(chat_sessions_dir, f"{session_id}.json")
-    with open(session_file, "w") as file:
-        json.dump({
-            "title": session_titles[session_id],
-            "history": [{"type": "human" if isinstance(msg, HumanMessage) else "system", "content": msg.content} for msg in chat_history]
-        }, file)
+    return [
+        HumanMessage(content=msg["content"]) if msg["type"] == "human" else SystemMessage(content=msg["content"])
+        for msg in session_store.load_messages(session_id)
+    ]
+
+# Function to append new messages to the session store
+def append_chat_history(session_id, messages):
+    session_store.append_messages(session_id, [
+        {"type": "human" if isinstance(msg, HumanMessage) else "system", "content": msg.content}
+        for msg in messages
+    ])
 
 class QueryRequest(BaseModel):
     query: str
     session_id: str
+    # Optionally answer only from these uploaded files
+    sources: list[str] | None = None
 
 class CreateSessionResponse(BaseModel):
     session_id: str
@@ -59,17 +46,50 @@ class CreateSessionResponse(BaseModel):
 @router.post("/create_chat_session", response_model=CreateSessionResponse)
 async def create_chat_session(request: Request):
     session_id = str(uuid.uuid4())
-    session_title = f"Session {len(session_titles) + 1}"
-    session_titles[session_id] = session_title
-    
-    save_chat_history(session_id, [])
+    session_title = f"Session {session_store.count_sessions() + 1}"
+    session_store.create_session(session_id, session_title)
     base_url = str(request.url_for("create_chat_session")).replace("create_chat_session", f"chat/{session_id}")
     return {"session_id": session_id, "session_url": base_url, "title": session_title}
 
+async def answer_and_record(session_id, query, sources=None):
+    # Streams the answer to `query` and records the turn in the session. Used by /chat
+    # and by /ws/audio_chat for transcribed questions.
+    from chatbot import generate_title, get_llm, stream_rag_answer, summarize_history  # Lazy import to avoid circular dependency
+
+    session = session_store.get_session(session_id)
+    if session is None:
+        session = {"title": f"Session {session_store.count_sessions() + 1}"}
+        session_store.create_session(session_id, session["title"])
+    # Recent turns within the token budget plus a summary of the older ones
+    chat_history = load_prompt_history(session_id)
+
+    # The title is generated concurrently with the answer instead of before it
+    title_task = None
+    if session["title"].startswith("Session"):
+        title_task = asyncio.create_task(generate_title(get_llm(TITLE_MODEL), query))
+
+    response_chunks = []
+    try:
+        async for chunk in stream_rag_answer(query, chat_history, sources):
+            response_chunks.append(chunk)
+            yield chunk
+
+        if title_task is not None:
+            try:
+                session_store.set_title(session_id, await title_task)
+            except Exception as e:
+                print(f"Title generation failed: {str(e)}")
+    finally:
+        # Stops the title request when the client disconnects or answering fails
+        if title_task is not None:
+            title_task.cancel()
+
+    final_response = "".join(response_chunks)
+    append_chat_history(session_id, [HumanMessage(content=query), SystemMessage(content=final_response)])
+    schedule_summary_update(session_id, summarize_history)
+
 @router.post("/chat")
 async def chat_endpoint(request: QueryRequest):
-    from chatbot import generate_title, text_rag_chain, text_llm  # Lazy import to avoid circular dependency
-
     query = request.query
     session_id = request.session_id
 
@@ -79,36 +99,14 @@ async def chat_endpoint(request: QueryRequest):
     if not session_id:
         raise HTTPException(status_code=400, detail="Session ID cannot be empty")
 
-    chat_history = load_chat_history(session_id)
-
-    if session_titles[session_id].startswith("Session"):
-        session_titles[session_id] = generate_title(text_llm, query)
-
-    async def answer_generator():
-        response_chunks = []
-        async for chunk in text_rag_chain.astream({"input": query, "chat_history": chat_history}):
-            if 'context' in chunk:
-                for doc in chunk['context']:
-                    print(f"Source: {doc.metadata['source']}")
-                    print("Content:")
-                    print(doc.page_content)
-                    print("\n" + "-"*80 + "\n")
-            if 'answer' in chunk:
-                response_chunks.append(chunk['answer'])
-                yield chunk['answer']
-        
-        final_response = "".join(response_chunks)
-        chat_history.append(HumanMessage(content=query))
-        chat_history.append(SystemMessage(content=final_response))
-        save_chat_history(session_id, chat_history)
-
-    return StreamingResponse(answer_generator(), media_type="text/plain")
+    return StreamingResponse(answer_and_record(session_id, query, request.sources), media_type="text/plain")
 
 @router.get("/session/{session_id}/title")
 async def get_session_title(session_id: str):
-    if session_id not in session_titles:
+    session = session_store.get_session(session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    return {"title": session_titles[session_id]}
+    return {"title": session["title"]}
 
 @router.get("/chat_history/{session_id}")
 async def get_chat_history(session_id: str = Path(..., description="The ID of the session to retrieve chat history for")):
@@ -119,25 +117,15 @@ async def get_chat_history(session_id: str = Path(..., description="The ID of th
     ]
 
 @router.get("/chat_sessions")
-async def get_chat_sessions():
-    if not os.path.exists(chat_sessions_dir):
-        return []
-
-    sessions = []
-    for session_file in os.listdir(chat_sessions_dir):
-        session_id, ext = os.path.splitext(session_file)
-        if ext == ".json":
-            with open(os.path.join(chat_sessions_dir, session_file), "r") as file:
-                session_data = json.load(file)
-                title = session_data.get("title", f"Session {session_id}")
-                session_titles[session_id] = title
-                sessions.append({"session_id": session_id, "title": title})
-    return sessions
+async def get_chat_sessions(limit: int | None = None, offset: int = 0):
+    # Most recently active sessions first
+    return [
+        {"session_id": session["id"], "title": session["title"]}
+        for session in session_store.list_sessions(limit=limit, offset=offset)
+    ]
 
 @router.post("/upload_file")
 async def upload_file(file: UploadFile = File(...)):
-    from chatbot import update_vector_store  # Lazy import to avoid circular dependency
-
     # Validate file type and extension
     valid_types = {
         "pdf": "application/pdf",
@@ -163,89 +151,183 @@ async def upload_file(file: UploadFile = File(...)):
         with open(file_path, "wb") as f:
             shutil.copyfileobj(file.file, f)
         
-        # Update the vector store to include the new file
-        update_vector_store()
+        # Queue the file for ingestion, progress is available from /ingest_jobs/{job_id}
+        job_id = enqueue_job("upload", file.filename)
         
-        return {"filename": file.filename, "message": f"{file_ext.upper()} file uploaded successfully"}
+        return {"filename": file.filename, "job_id": job_id, "message": f"{file_ext.upper()} file uploaded successfully, ingestion queued"}
     
     except Exception as e:
         if os.path.exists(file_path):
             os.unlink(file_path)
         raise HTTPException(status_code=500, detail=f"An error occurred while processing the file: {str(e)}")
 
-@router.delete("/delete_file/{filename}")
+@router.delete("/delete_file/{filename:path}")
 async def delete_file(filename: str):
-    from chatbot import update_vector_store  # Lazy import to avoid circular dependency
-
-    file_path = os.path.join(files_dir, filename)
+    # `filename` is a path relative to the files directory, as listed by /list_files
+    root = os.path.realpath(files_dir)
+    file_path = os.path.realpath(os.path.join(root, filename))
     
-    if not os.path.exists(file_path):
+    if os.path.commonpath([root, file_path]) != root or not os.path.isfile(file_path):
         raise HTTPException(status_code=404, detail="File not found")
+    filename = os.path.relpath(file_path, root).replace(os.sep, "/")
     
     # Delete the file
     os.remove(file_path)
     
-    # Update the vector store to remove the file
-    update_vector_store()
+    # Queue the removal of the file's vectors
+    job_id = enqueue_job("delete", filename)
     
-    return {"filename": filename, "message": "File deleted successfully"}
+    return {"filename": filename, "job_id": job_id, "message": "File deleted successfully"}
+
+@router.get("/embedding_cache")
+async def get_embedding_cache_stats():
+    from chatbot import embeddings  # Lazy import to avoid circular dependency
+
+    return embeddings.cache.stats()
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    from chatbot import answer_cache, embeddings  # Lazy import to avoid circular dependency
+
+    answer_stats = answer_cache.stats()
+    embedding_stats = embeddings.cache.stats()
+    return render_metrics([
+        counter("rag_answer_cache_hits_total", "Answer cache hits", answer_stats["hits"]),
+        counter("rag_answer_cache_misses_total", "Answer cache misses", answer_stats["misses"]),
+        gauge("rag_answer_cache_entries", "Answers currently cached", answer_stats["entries"]),
+        counter("rag_embedding_cache_hits_total", "Embedding cache hits", embedding_stats["hits"]),
+        counter("rag_embedding_cache_misses_total", "Embedding cache misses", embedding_stats["misses"]),
+        gauge("rag_embedding_cache_entries", "Embeddings stored on disk", embedding_stats["entries"]),
+    ])
+
+@router.get("/healthz")
+async def get_health():
+    # Liveness: the process is up and serving requests
+    return {"status": "ok"}
+
+@router.get("/readyz")
+async def get_readiness():
+    # Readiness: the vector store is open and retrieval can serve /chat. The startup
+    # reconciliation with the files directory may still be running.
+    from chatbot import startup_state  # Lazy import to avoid circular dependency
+
+    state = dict(startup_state)
+    job_id = state.get("reconcile_job")
+    if job_id is not None:
+        job = get_job(job_id)
+        state["reconcile_status"] = job["status"] if job is not None else None
+    return JSONResponse(content=state, status_code=200 if state["ready"] else 503)
+
+@router.get("/answer_cache")
+async def get_answer_cache_stats():
+    from chatbot import answer_cache  # Lazy import to avoid circular dependency
+
+    return answer_cache.stats()
+
+@router.get("/ingest_jobs")
+async def get_ingest_jobs(limit: int = 50):
+    return list_jobs(limit)
+
+@router.get("/ingest_jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
+    return job
+
+@router.post("/ingest_jobs/{job_id}/cancel")
+async def cancel_ingest_job(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
+    if job["status"] in FINISHED_STATES:
+        raise HTTPException(status_code=409, detail=f"Ingestion job already {job['status']}")
+    return request_cancel(job_id)
 
 @router.delete("/delete_chat_session/{session_id}")
 async def delete_chat_session(session_id: str = Path(..., description="The ID of the session to delete")):
-    session_file = os.path.join(chat_sessions_dir, f"{session_id}.json")
-    if os.path.exists(session_file):
-        os.remove(session_file)
+    if session_store.delete_session(session_id):
         return {"session_id": session_id, "message": "Chat session deleted successfully"}
     else:
         raise HTTPException(status_code=404, detail="Chat session not found")
 
 @router.get("/list_files")
 async def list_files():
+    # Every supported file under the files directory, by the path ingestion indexes it as
     try:
-        files = {
-            "pdf_files": [f for f in os.listdir(files_dir) if f.endswith('.pdf')],
-            "csv_files": [f for f in os.listdir(files_dir) if f.endswith('.csv')],
-            "xlsx_files": [f for f in os.listdir(files_dir) if f.endswith('.xlsx')],
-            "xls_files": [f for f in os.listdir(files_dir) if f.endswith('.xls')],
-            "json_files": [f for f in os.listdir(files_dir) if f.endswith('.json')],
-            "jpg_files": [f for f in os.listdir(files_dir) if f.endswith('.jpg')],
-            "jpeg_files": [f for f in os.listdir(files_dir) if f.endswith('.jpeg')],
-            "png_files": [f for f in os.listdir(files_dir) if f.endswith('.png')],
-        }
-        # Flatten the lists into a single list
-        all_files = [file for sublist in files.values() for file in sublist]
+        all_files = await asyncio.to_thread(list_source_files, files_dir)
         return JSONResponse(content=all_files)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
     
 @router.websocket("/ws/audio_chat")
-async def websocket_audio_chat(websocket: WebSocket, session_id: str):
+async def websocket_audio_chat(websocket: WebSocket, session_id: str, stream: bool = False, answer: bool = False):
+    # By default every binary message is a whole recording and its transcript is sent
+    # back as plain text. Either option switches replies to JSON objects with a "type":
+    # - stream: binary messages are consecutive pieces of one recording, finished by
+    #   the text message "end". "partial" transcripts are sent while audio arrives,
+    #   then the "transcript".
+    # - answer: the transcript is also answered like a /chat query in this session,
+    #   streamed as "answer" pieces followed by "answer_end".
     await websocket.accept()
-    audio_file = f"temp_audio_{session_id}.wav"
+    json_replies = stream or answer
+    transcript = StreamingTranscript()
+    partial_task = None
+
+    async def send(kind, text):
+        if json_replies:
+            await websocket.send_json({"type": kind, "text": text})
+        else:
+            await websocket.send_text(text)
+
+    async def send_partial(recording):
+        try:
+            text = await recording.partial()
+        except Exception as e:
+            # The audio received so far may not decode yet, the final transcript will tell
+            print(f"Partial transcription failed: {str(e)}")
+            return
+        if text is not None:
+            await send("partial", text)
+
+    async def finish_recording():
+        nonlocal transcript, partial_task
+        recording, transcript = transcript, StreamingTranscript()
+        if partial_task is not None:
+            await partial_task
+            partial_task = None
+        text = await recording.final()
+        await send("transcript", text)
+        if answer and text:
+            async for chunk in answer_and_record(session_id, text):
+                await send("answer", chunk)
+            await send("answer_end", "")
 
     try:
         while True:
-            data = await websocket.receive_bytes()
-
-            # Write received audio data to file
-            with open(audio_file, "wb") as f:
-                f.write(data)
-
-            # Transcribe the audio
-            result = whisper_model.transcribe(audio_file)
-            text_query = result['text']
-
-            # Send the transcription back to the client
-            await websocket.send_text(text_query)
-
-            # Delete the temporary file after sending the response
-            if os.path.exists(audio_file):
-                os.remove(audio_file)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            try:
+                if message.get("bytes") is not None:
+                    transcript.add(message["bytes"])
+                    if len(transcript.data) > AUDIO_MAX_BYTES:
+                        transcript = StreamingTranscript()
+                        raise ValueError(f"Recording exceeds {AUDIO_MAX_BYTES} bytes")
+                    if not stream:
+                        await finish_recording()
+                    elif partial_task is None or partial_task.done():
+                        if time.monotonic() - transcript.last_partial >= TRANSCRIBE_PARTIAL_INTERVAL:
+                            partial_task = asyncio.create_task(send_partial(transcript))
+                elif stream and message.get("text") == "end":
+                    await finish_recording()
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                # The connection stays open for the next recording
+                await send("error", f"Error: {str(e)}")
 
     except WebSocketDisconnect:
         print(f"Client {session_id} disconnected")
-    except Exception as e:
-        await websocket.send_text(f"Error: {str(e)}")
-        # Ensure temporary file is deleted even if an error occurs
-        if os.path.exists(audio_file):
-            os.remove(audio_file)
\ No newline at end of file
+        if partial_task is not None:
+            partial_task.cancel()
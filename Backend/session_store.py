@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import threading
+from config import chat_sessions_dir
+
+# Chat sessions in SQLite: a sessions table with the title and timestamps, indexed
+# for listing by most recent activity, and an append-only messages table. A turn
+# appends its messages in one write transaction, so concurrent requests on the same
+# session never overwrite each other.
+
+sessions_db_file = os.path.join(chat_sessions_dir, "sessions.sqlite3")
+imported_sessions_dir = os.path.join(chat_sessions_dir, "imported")
+import_lock_file = os.path.join(chat_sessions_dir, ".import.lock")
+
+_lock = threading.Lock()
+
+if not os.path.exists(chat_sessions_dir):
+    os.makedirs(chat_sessions_dir)
+
+_conn = sqlite3.connect(sessions_db_file, timeout=30, check_same_thread=False, isolation_level=None)
+_conn.row_factory = sqlite3.Row
+_conn.execute("PRAGMA journal_mode=WAL")
+_conn.execute(
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """
+)
+_conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions (updated_at DESC)")
+_conn.execute(
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        session_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (session_id, seq)
+    )
+    """
+)
+
+# Rolling summary of the messages before `covered` (a message count), see chat_memory.py
+_conn.execute(
+    """
+    CREATE TABLE IF NOT EXISTS summaries (
+        session_id TEXT PRIMARY KEY,
+        summary TEXT NOT NULL,
+        covered INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """
+)
+
+
+def _json_session_files():
+    return [f for f in os.listdir(chat_sessions_dir) if f.endswith(".json")]
+
+
+def _import_json_sessions():
+    # Sessions saved as one JSON file each by earlier versions are imported once and
+    # the files moved aside. Server processes started together import under a file
+    # lock, the first one imports everything and the others find nothing left.
+    if not _json_session_files():
+        return
+    with open(import_lock_file, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            _import_session_files(_json_session_files())
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _import_session_files(session_files):
+    if not session_files:
+        return
+    os.makedirs(imported_sessions_dir, exist_ok=True)
+    for session_file in session_files:
+        session_id = os.path.splitext(session_file)[0]
+        path = os.path.join(chat_sessions_dir, session_file)
+        with open(path, "r") as file:
+            session_data = json.load(file)
+        modified = os.path.getmtime(path)
+        with _lock:
+            _conn.execute("BEGIN IMMEDIATE")
+            _conn.execute(
+                "INSERT OR IGNORE INTO sessions (id, title, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (session_id, session_data.get("title") or f"Session {session_id}", modified, modified),
+            )
+            _conn.executemany(
+                "INSERT OR IGNORE INTO messages (session_id, seq, type, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (session_id, seq, msg["type"], msg["content"], modified)
+                    for seq, msg in enumerate(session_data.get("history", []))
+                ],
+            )
+            _conn.execute("COMMIT")
+        shutil.move(path, os.path.join(imported_sessions_dir, session_file))
+    print(f"Imported {len(session_files)} chat sessions into {sessions_db_file}")
+
+
+_import_json_sessions()
+
+
+def create_session(session_id, title):
+    now = time.time()
+    with _lock:
+        _conn.execute(
+            "INSERT OR IGNORE INTO sessions (id, title, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (session_id, title, now, now),
+        )
+
+
+def get_session(session_id):
+    with _lock:
+        row = _conn.execute("SELECT id, title, created_at, updated_at FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def count_sessions():
+    with _lock:
+        return _conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def list_sessions(limit=None, offset=0):
+    with _lock:
+        rows = _conn.execute(
+            "SELECT id, title, updated_at FROM sessions ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+            (limit if limit is not None else -1, offset),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def set_title(session_id, title):
+    with _lock:
+        _conn.execute("UPDATE sessions SET title = ? WHERE id = ?", (title, session_id))
+
+
+def load_messages(session_id, since=0):
+    # Messages from position `since` on, oldest first
+    with _lock:
+        rows = _conn.execute(
+            "SELECT type, content FROM messages WHERE session_id = ? AND seq >= ? ORDER BY seq", (session_id, since)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def append_messages(session_id, messages):
+    # `messages` is a list of {"type", "content"} dicts. Sequence numbers are assigned
+    # inside the write transaction, so concurrent appends are serialized.
+    now = time.time()
+    with _lock:
+        _conn.execute("BEGIN IMMEDIATE")
+        try:
+            next_seq = _conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+            _conn.executemany(
+                "INSERT INTO messages (session_id, seq, type, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(session_id, next_seq + i, msg["type"], msg["content"], now) for i, msg in enumerate(messages)],
+            )
+            _conn.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (now, session_id))
+            _conn.execute("COMMIT")
+        except BaseException:
+            _conn.execute("ROLLBACK")
+            raise
+
+
+def get_summary(session_id):
+    # Returns (summary, number of messages it covers)
+    with _lock:
+        row = _conn.execute("SELECT summary, covered FROM summaries WHERE session_id = ?", (session_id,)).fetchone()
+    return (row["summary"], row["covered"]) if row else ("", 0)
+
+
+def set_summary(session_id, summary, covered, previously_covered):
+    # Only replaces the summary it was computed from, so two concurrent updates of the
+    # same session cannot move it backwards. Returns False if another update won.
+    now = time.time()
+    with _lock:
+        if previously_covered == 0:
+            changed = _conn.execute(
+                "INSERT OR IGNORE INTO summaries (session_id, summary, covered, updated_at) VALUES (?, ?, ?, ?)",
+                (session_id, summary, covered, now),
+            ).rowcount
+        else:
+            changed = _conn.execute(
+                "UPDATE summaries SET summary = ?, covered = ?, updated_at = ? WHERE session_id = ? AND covered = ?",
+                (summary, covered, now, session_id, previously_covered),
+            ).rowcount
+    return changed > 0
+
+
+def delete_session(session_id):
+    with _lock:
+        _conn.execute("BEGIN IMMEDIATE")
+        deleted = _conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount
+        _conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        _conn.execute("DELETE FROM summaries WHERE session_id = ?", (session_id,))
+        _conn.execute("COMMIT")
+    return deleted > 0
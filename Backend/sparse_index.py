@@ -0,0 +1,149 @@
+import re
+import math
+
+# Keyword index over the chunk texts, stored in the manifest database so it is
+# committed in the same transaction as the manifest and can never disagree with it.
+# SQLite FTS5 ranks matches with BM25. Hyphens and underscores are kept inside tokens
+# so identifiers such as SKUs and column values match exactly.
+
+_token_pattern = re.compile(r"[\w\-]+")
+
+
+def create_tables(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS chunk_text (id INTEGER PRIMARY KEY, chunk_id TEXT UNIQUE NOT NULL, content TEXT NOT NULL)"
+    )
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS chunk_fts USING fts5(
+            content, content='chunk_text', content_rowid='id', tokenize="unicode61 tokenchars '-_'"
+        )
+        """
+    )
+    # Per term document counts, used to leave out terms most chunks contain
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunk_vocab USING fts5vocab(chunk_fts, 'row')")
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS chunk_text_insert AFTER INSERT ON chunk_text BEGIN
+            INSERT INTO chunk_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS chunk_text_delete AFTER DELETE ON chunk_text BEGIN
+            INSERT INTO chunk_fts (chunk_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        """
+    )
+
+
+def add_chunks(conn, chunks):
+    # `chunks` is a list of (chunk_id, text) pairs
+    conn.executemany("INSERT OR IGNORE INTO chunk_text (chunk_id, content) VALUES (?, ?)", chunks)
+
+
+def remove_chunks(conn, chunk_ids):
+    conn.executemany("DELETE FROM chunk_text WHERE chunk_id = ?", [(chunk_id,) for chunk_id in chunk_ids])
+
+
+def missing_chunks(conn):
+    # Chunks in the manifest without text in the index, e.g. indexed by an earlier version
+    rows = conn.execute(
+        "SELECT DISTINCT chunk_id FROM file_chunks WHERE chunk_id NOT IN (SELECT chunk_id FROM chunk_text)"
+    ).fetchall()
+    return [chunk_id for (chunk_id,) in rows]
+
+
+def backfill(db, conn):
+    # Adds the chunks of earlier versions from Chroma. Runs once per manifest, flagged in
+    # collection_state, since every chunk committed since has its text in the index.
+    # Returns whether anything was added.
+    if conn.execute("SELECT 1 FROM collection_state WHERE name = 'keyword_index_backfilled'").fetchone():
+        return False
+    missing = missing_chunks(conn)
+    if missing:
+        print(f"\nAdding {len(missing)} stored chunks to the keyword index")
+    for start in range(0, len(missing), 500):
+        stored = db.get(ids=missing[start:start + 500], include=["documents"])
+        with conn:
+            add_chunks(conn, list(zip(stored["ids"], stored["documents"])))
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO collection_state (name, value) VALUES ('keyword_index_backfilled', 1)")
+    return bool(missing)
+
+
+def get_chunks(conn, chunk_ids):
+    # Returns {chunk_id: (text, source)}, with one of the sources for shared chunks
+    found = {}
+    for start in range(0, len(chunk_ids), 500):
+        batch = chunk_ids[start:start + 500]
+        placeholders = ",".join("?" * len(batch))
+        rows = conn.execute(
+            f"""
+            SELECT t.chunk_id, t.content, MIN(f.source) FROM chunk_text t
+            JOIN file_chunks f ON f.chunk_id = t.chunk_id
+            WHERE t.chunk_id IN ({placeholders}) GROUP BY t.chunk_id
+            """,
+            batch,
+        ).fetchall()
+        found.update((chunk_id, (content, source)) for chunk_id, content, source in rows)
+    return found
+
+
+def terms(text):
+    # Distinct lowercased terms, tokenized like the index
+    return list(dict.fromkeys(token.lower() for token in _token_pattern.findall(text)))
+
+
+def term_weights(conn, text):
+    # BM25 inverse document frequency of each of the text's terms
+    query_terms = terms(text)
+    if not query_terms:
+        return {}
+    total = conn.execute("SELECT COUNT(*) FROM chunk_text").fetchone()[0]
+    rows = conn.execute(
+        f"SELECT term, doc FROM chunk_vocab WHERE term IN ({','.join('?' * len(query_terms))})", query_terms
+    ).fetchall()
+    documents = dict(rows)
+    return {
+        term: math.log(1 + (total - documents.get(term, 0) + 0.5) / (documents.get(term, 0) + 0.5))
+        for term in query_terms
+    }
+
+
+def match_query(conn, text, max_document_fraction=0.5):
+    # Any of the query's terms may match, BM25 ranks chunks matching more and rarer
+    # terms higher. Terms found in most chunks ("what", "the", a column name present in
+    # every row) barely change the ranking but make every chunk a match to be scored,
+    # so they are left out. Terms are quoted so FTS5 operators are not interpreted.
+    query_terms = terms(text)
+    if not query_terms:
+        return ""
+    total = conn.execute("SELECT COUNT(*) FROM chunk_text").fetchone()[0]
+    rows = conn.execute(
+        f"SELECT term, doc FROM chunk_vocab WHERE term IN ({','.join('?' * len(query_terms))})", query_terms
+    ).fetchall()
+    common = {term for term, documents in rows if documents > total * max_document_fraction}
+    selective = [term for term in query_terms if term not in common] or query_terms
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in selective)
+
+
+def search(conn, text, limit, sources=None):
+    # Returns chunk ids, best match first, optionally only chunks of the given files
+    query = match_query(conn, text)
+    if not query:
+        return []
+    source_filter = ""
+    parameters = [query]
+    if sources is not None:
+        source_filter = f"AND t.chunk_id IN (SELECT chunk_id FROM file_chunks WHERE source IN ({','.join('?' * len(sources))}))"
+        parameters.extend(sources)
+    rows = conn.execute(
+        f"""
+        SELECT t.chunk_id FROM chunk_fts JOIN chunk_text t ON t.id = chunk_fts.rowid
+        WHERE chunk_fts MATCH ? {source_filter} ORDER BY chunk_fts.rank LIMIT ?
+        """,
+        (*parameters, limit),
+    ).fetchall()
+    return [chunk_id for (chunk_id,) in rows]
@@ -0,0 +1,393 @@
+import os
+import re
+import csv
+import json
+import time
+import sqlite3
+import hashlib
+from datetime import date, datetime, time as datetime_time
+from manifest import file_sha256
+from config import db_dir, TABULAR_SAMPLE_ROWS, TABLE_QUERY_MAX_ROWS, TABLE_QUERY_TIMEOUT
+
+# CSV and XLSX files are loaded into SQLite tables instead of being chunked row by row.
+# Only a description of each table (columns, types, value ranges and a few sample rows)
+# is embedded, so a large spreadsheet costs a handful of embeddings, and questions the
+# retriever routes to a table are answered with a SQL query against it, see chatbot.py.
+#
+# Every table is registered with its source file and its description, which doubles
+# as the cached schema given to the model writing the query.
+#
+# Every spreadsheet loaded this way is recorded in `sources`, also when it has no
+# rows, so only files indexed row by row by earlier versions are loaded again.
+#
+# A file is loaded into staging tables first. They replace the file's tables in
+# `publish_source` once ingestion committed its chunks, and are dropped when indexing
+# the file fails, so the tables always match what the manifest recorded. Staging
+# tables are prefixed with an underscore, which table names never start with.
+
+tables_db_file = os.path.join(db_dir, "tables.sqlite3")
+
+TABULAR_EXTENSIONS = (".csv", ".xlsx")
+
+# Numbers with leading zeros (codes, zip codes) stay text
+_integer_pattern = re.compile(r"[+-]?(0|[1-9]\d*)")
+_real_pattern = re.compile(r"[+-]?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?")
+
+
+class QueryError(Exception):
+    pass
+
+
+def is_tabular(filename):
+    return filename.lower().endswith(TABULAR_EXTENSIONS)
+
+
+def _connect():
+    os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(tables_db_file, timeout=300)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tables (
+            name TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            sheet TEXT,
+            columns TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            description TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tables_source ON tables (source)")
+    conn.execute("CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, sha256 TEXT NOT NULL)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS staged_tables (
+            name TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            sheet TEXT,
+            columns TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            description TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS staged_sources (source TEXT PRIMARY KEY, sha256 TEXT NOT NULL)")
+    return conn
+
+
+def _identifier(text, fallback):
+    name = re.sub(r"[^0-9a-zA-Z]+", "_", str(text or "")).strip("_").lower()
+    if not name:
+        name = fallback
+    if name[0].isdigit():
+        name = f"c_{name}"
+    return name
+
+
+def _table_name(filename, sheet):
+    # Readable for the model writing queries, unique thanks to the filename hash
+    stem = _identifier(os.path.splitext(filename)[0], "table")[:40]
+    suffix = hashlib.sha256(f"{filename}\0{sheet or ''}".encode("utf-8")).hexdigest()[:6]
+    if sheet is not None:
+        stem = f"{stem}_{_identifier(sheet, 'sheet')[:20]}"
+    return f"{stem}_{suffix}"
+
+
+def _staged_name(table):
+    return f"_staged_{table}"
+
+
+def _column_names(header):
+    names = []
+    for index, title in enumerate(header):
+        name = _identifier(title, f"column_{index + 1}")
+        while name in names:
+            name = f"{name}_{index + 1}"
+        names.append(name)
+    return names
+
+
+def _convert(value):
+    # Cells become integers, reals or text, so aggregates work on numeric columns
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, (datetime, date, datetime_time)):
+        return value.isoformat()
+    text = str(value).strip()
+    if not text:
+        return None
+    if _integer_pattern.fullmatch(text):
+        number = int(text)
+        # SQLite integers are 64 bit
+        return number if -2 ** 63 <= number < 2 ** 63 else text
+    if _real_pattern.fullmatch(text):
+        return float(text)
+    return text
+
+
+def _column_type(types):
+    if not types or str in types:
+        return "text"
+    return "real" if float in types else "integer"
+
+
+def _iter_csv(file_path):
+    with open(file_path, "r", newline="", encoding="utf-8-sig", errors="replace") as file:
+        yield None, csv.reader(file, delimiter=",")
+
+
+def _iter_xlsx(file_path):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield sheet.title, sheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _load_table(conn, table, rows):
+    # Returns the column descriptions, or None for an empty sheet
+    rows = iter(rows)
+    header = next((row for row in rows if any(cell not in (None, "") for cell in row)), None)
+    if header is None:
+        return None
+    names = _column_names(header)
+    types = [set() for _ in names]
+
+    def converted_rows():
+        for row in rows:
+            values = [_convert(cell) for cell in row[:len(names)]]
+            if all(value is None for value in values):
+                continue
+            values.extend([None] * (len(names) - len(values)))
+            for column_types, value in zip(types, values):
+                if value is not None:
+                    column_types.add(type(value))
+            yield values
+
+    columns_sql = ", ".join(f'"{name}"' for name in names)
+    conn.execute(f'CREATE TABLE "{table}" ({columns_sql})')
+    conn.executemany(f'INSERT INTO "{table}" VALUES ({",".join("?" * len(names))})', converted_rows())
+    return [
+        {"name": name, "header": str(title) if title is not None else "", "type": _column_type(column_types)}
+        for name, title, column_types in zip(names, header, types)
+    ]
+
+
+def _describe(conn, stored_table, table, filename, sheet, columns, row_count):
+    # `stored_table` holds the rows of what will be `table`
+    origin = f"file {filename}" + (f", sheet {sheet}" if sheet is not None else "")
+    lines = [f"Table {table} ({origin}) with {row_count} rows.", "Columns:"]
+    for column in columns:
+        name = column["name"]
+        label = f" (\"{column['header']}\")" if column["header"] and column["header"] != name else ""
+        if column["type"] == "text":
+            examples = [
+                value for (value,) in conn.execute(
+                    f'SELECT DISTINCT "{name}" FROM "{stored_table}" WHERE "{name}" IS NOT NULL LIMIT 3'
+                )
+            ]
+            detail = "e.g. " + ", ".join(str(value)[:40] for value in examples) if examples else "empty"
+        else:
+            low, high = conn.execute(f'SELECT MIN("{name}"), MAX("{name}") FROM "{stored_table}"').fetchone()
+            detail = f"from {low} to {high}"
+        lines.append(f"- {name}{label}: {column['type']}, {detail}")
+
+    samples = conn.execute(f'SELECT * FROM "{stored_table}" LIMIT ?', (TABULAR_SAMPLE_ROWS,)).fetchall()
+    if samples:
+        lines.append("Sample rows:")
+        lines.append(" | ".join(column["name"] for column in columns))
+        lines.extend(" | ".join("" if value is None else str(value) for value in row) for row in samples)
+    return "\n".join(lines)
+
+
+def ingest_file(file_path, filename):
+    # Loads the tables of `filename` into staging tables in one transaction and returns
+    # their descriptions, see `publish_source`
+    sha256 = file_sha256(file_path)
+    sheets = _iter_csv(file_path) if filename.lower().endswith(".csv") else _iter_xlsx(file_path)
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            _drop_staged(conn, filename)
+            conn.execute("INSERT INTO staged_sources (source, sha256) VALUES (?, ?)", (filename, sha256))
+            descriptions = []
+            for sheet, rows in sheets:
+                table = _table_name(filename, sheet)
+                staged = _staged_name(table)
+                columns = _load_table(conn, staged, rows)
+                if columns is None:
+                    continue
+                row_count = conn.execute(f'SELECT COUNT(*) FROM "{staged}"').fetchone()[0]
+                description = _describe(conn, staged, table, filename, sheet, columns, row_count)
+                conn.execute(
+                    "INSERT INTO staged_tables (name, source, sheet, columns, row_count, description) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (table, filename, sheet, json.dumps(columns), row_count, description),
+                )
+                descriptions.append(description)
+        return descriptions
+    finally:
+        conn.close()
+
+
+def _drop_source(conn, filename):
+    for (table,) in conn.execute("SELECT name FROM tables WHERE source = ?", (filename,)).fetchall():
+        conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+    conn.execute("DELETE FROM tables WHERE source = ?", (filename,))
+    conn.execute("DELETE FROM sources WHERE source = ?", (filename,))
+
+
+def _drop_staged(conn, filename):
+    for (table,) in conn.execute("SELECT name FROM staged_tables WHERE source = ?", (filename,)).fetchall():
+        conn.execute(f'DROP TABLE IF EXISTS "{_staged_name(table)}"')
+    conn.execute("DELETE FROM staged_tables WHERE source = ?", (filename,))
+    conn.execute("DELETE FROM staged_sources WHERE source = ?", (filename,))
+
+
+def publish_source(filename):
+    # Replaces the tables of `filename` with its staging tables, if it has any
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM staged_sources WHERE source = ?", (filename,)).fetchone() is None:
+                return
+            _drop_source(conn, filename)
+            for (table,) in conn.execute("SELECT name FROM staged_tables WHERE source = ?", (filename,)).fetchall():
+                conn.execute(f'ALTER TABLE "{_staged_name(table)}" RENAME TO "{table}"')
+            conn.execute(
+                "INSERT INTO tables (name, source, sheet, columns, row_count, description) "
+                "SELECT name, source, sheet, columns, row_count, description FROM staged_tables WHERE source = ?",
+                (filename,),
+            )
+            conn.execute("DELETE FROM staged_tables WHERE source = ?", (filename,))
+            conn.execute(
+                "INSERT INTO sources (source, sha256) SELECT source, sha256 FROM staged_sources WHERE source = ?",
+                (filename,),
+            )
+            conn.execute("DELETE FROM staged_sources WHERE source = ?", (filename,))
+    finally:
+        conn.close()
+
+
+def discard_staged(filename):
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            _drop_staged(conn, filename)
+    finally:
+        conn.close()
+
+
+def recover_staged(indexed_files):
+    # Staging tables left by an interrupted run are swapped in when the manifest already
+    # records their file's content, and dropped otherwise. `indexed_files` is the
+    # manifest's {filename: entry}.
+    if not os.path.exists(tables_db_file):
+        return
+    conn = _connect()
+    try:
+        staged = conn.execute("SELECT source, sha256 FROM staged_sources").fetchall()
+    finally:
+        conn.close()
+    for source, sha256 in staged:
+        entry = indexed_files.get(source)
+        if entry is not None and entry["sha256"] == sha256:
+            publish_source(source)
+        else:
+            discard_staged(source)
+
+
+def remove_source(filename):
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            _drop_source(conn, filename)
+    finally:
+        conn.close()
+
+
+def rename_source(old_name, new_name):
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("UPDATE tables SET source = ? WHERE source = ?", (new_name, old_name))
+            conn.execute("UPDATE OR REPLACE sources SET source = ? WHERE source = ?", (new_name, old_name))
+    finally:
+        conn.close()
+
+
+def indexed_sources():
+    # Spreadsheets loaded as tables. Tables loaded before `sources` existed count too.
+    if not os.path.exists(tables_db_file):
+        return set()
+    conn = _connect()
+    try:
+        return {source for (source,) in conn.execute("SELECT source FROM sources UNION SELECT source FROM tables")}
+    finally:
+        conn.close()
+
+
+def tables_for_sources(sources):
+    # Returns [(table name, source, description)] of the tables loaded from `sources`
+    sources = list(sources)
+    if not sources or not os.path.exists(tables_db_file):
+        return []
+    conn = _connect()
+    try:
+        return conn.execute(
+            f"SELECT name, source, description FROM tables WHERE source IN ({','.join('?' * len(sources))}) ORDER BY name",
+            sources,
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def _authorize(action, arg1, arg2, database, trigger):
+    # Queries may only read
+    if action in (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE):
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+
+def run_query(sql, max_rows=TABLE_QUERY_MAX_ROWS, timeout=TABLE_QUERY_TIMEOUT):
+    # Runs one read-only SELECT and returns (column names, rows, truncated). Raises
+    # QueryError for anything else, for invalid SQL and when it runs out of time.
+    sql = sql.strip().rstrip(";").strip()
+    if not re.match(r"(?is)^(select|with)\b", sql):
+        raise QueryError("Only SELECT queries are allowed")
+    if not os.path.exists(tables_db_file):
+        raise QueryError("No tables have been loaded")
+
+    conn = sqlite3.connect(f"file:{tables_db_file}?mode=ro", uri=True, timeout=30)
+    deadline = time.monotonic() + timeout
+    try:
+        conn.set_authorizer(_authorize)
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+        cursor = conn.execute(sql)
+        rows = cursor.fetchmany(max_rows + 1)
+        columns = [description[0] for description in cursor.description or []]
+    except sqlite3.Error as e:
+        raise QueryError(str(e)) from e
+    finally:
+        conn.close()
+    return columns, rows[:max_rows], len(rows) > max_rows
+
+
+def format_result(columns, rows, truncated):
+    lines = [" | ".join(columns)]
+    lines.extend(" | ".join("" if value is None else str(value) for value in row) for row in rows)
+    if truncated:
+        lines.append(f"(only the first {len(rows)} rows are shown)")
+    return "\n".join(lines)
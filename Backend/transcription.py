@@ -0,0 +1,150 @@
+import time
+import queue
+import asyncio
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from config import WHISPER_MODEL, TRANSCRIBE_WORKERS, TRANSCRIBE_MAX_PENDING
+from metrics import audio_stage_seconds
+
+# Speech to text for /ws/audio_chat. Audio is decoded in memory by piping it through
+# ffmpeg, the way whisper.load_audio does for files, and transcribed on a small pool
+# of worker threads so the event loop never blocks on Whisper.
+#
+# A Whisper model cannot run two transcriptions at once (decoding installs hooks on
+# the model), so every worker gets its own model, loaded on first use.
+
+SAMPLE_RATE = 16000
+
+_models = queue.Queue()
+_models_created = 0
+_models_lock = threading.Lock()
+_executor = None
+# Transcriptions submitted and not finished yet. Only touched from the event loop.
+_pending = 0
+
+
+def _acquire_model():
+    global _models_created
+    try:
+        return _models.get_nowait()
+    except queue.Empty:
+        pass
+    with _models_lock:
+        load = _models_created < TRANSCRIBE_WORKERS
+        if load:
+            _models_created += 1
+    if not load:
+        return _models.get()
+
+    import whisper
+
+    print(f"Loading Whisper model {WHISPER_MODEL}")
+    try:
+        return whisper.load_model(WHISPER_MODEL)
+    except Exception:
+        with _models_lock:
+            _models_created -= 1
+        raise
+
+
+def preload_model():
+    _models.put(_acquire_model())
+
+
+def decode_audio(data):
+    # Any container or codec ffmpeg understands, to 16 kHz mono float32 samples.
+    # A truncated stream, like a recording still in progress, decodes up to the cut.
+    process = subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-threads", "0", "-i", "pipe:0",
+         "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "pipe:1"],
+        input=bytes(data), capture_output=True,
+    )
+    if process.returncode != 0 and not process.stdout:
+        raise RuntimeError(f"Failed to decode audio: {process.stderr.decode(errors='replace').strip()[-500:]}")
+    return np.frombuffer(process.stdout, np.int16).astype(np.float32) / 32768.0
+
+
+def _transcribe(data, offset, keep_last_segment):
+    # Runs on a worker thread. Transcribes the audio after `offset` seconds and returns
+    # (settled text, tentative text, new offset). With `keep_last_segment` the last
+    # segment may still change as more audio arrives, so it is returned as tentative
+    # and the offset only moves past the segments before it.
+    with audio_stage_seconds.time("decode"):
+        audio = decode_audio(data)[int(offset * SAMPLE_RATE):]
+    if len(audio) == 0:
+        return "", "", offset
+
+    model = _acquire_model()
+    try:
+        with audio_stage_seconds.time("transcribe"):
+            segments = model.transcribe(audio)["segments"]
+    finally:
+        _models.put(model)
+
+    if not keep_last_segment:
+        return "".join(segment["text"] for segment in segments).strip(), "", offset + len(audio) / SAMPLE_RATE
+    settled = segments[:-1]
+    tentative = segments[-1:]
+    new_offset = offset + settled[-1]["end"] if settled else offset
+    return (
+        "".join(segment["text"] for segment in settled).strip(),
+        "".join(segment["text"] for segment in tentative).strip(),
+        new_offset,
+    )
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS, thread_name_prefix="transcribe")
+    return _executor
+
+
+async def transcribe(data, offset=0.0, keep_last_segment=False, optional=False):
+    # Returns the result of `_transcribe`, or None for an `optional` request (a partial
+    # transcript) while TRANSCRIBE_MAX_PENDING transcriptions are already waiting
+    global _pending
+    if optional and _pending >= TRANSCRIBE_MAX_PENDING:
+        return None
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            _get_executor(), _transcribe, bytes(data), offset, keep_last_segment
+        )
+    finally:
+        _pending -= 1
+
+
+class StreamingTranscript:
+    # Audio of one utterance arriving in pieces, e.g. MediaRecorder timeslices, which
+    # are consecutive parts of one encoded stream. Partial transcripts only transcribe
+    # the audio after the last settled segment, so the work per update stays bounded.
+
+    def __init__(self):
+        self.data = bytearray()
+        self.settled = []
+        self.offset = 0.0
+        self.last_partial = time.monotonic()
+
+    def add(self, chunk):
+        self.data.extend(chunk)
+
+    def _text(self, *parts):
+        return " ".join(part for part in (*self.settled, *parts) if part)
+
+    async def partial(self):
+        # Returns the transcript so far, or None when the pool is too busy for it
+        self.last_partial = time.monotonic()
+        result = await transcribe(self.data, self.offset, keep_last_segment=True, optional=True)
+        if result is None:
+            return None
+        settled, tentative, self.offset = result
+        if settled:
+            self.settled.append(settled)
+        return self._text(tentative)
+
+    async def final(self):
+        text, _, self.offset = await transcribe(self.data, self.offset)
+        return self._text(text)
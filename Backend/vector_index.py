@@ -0,0 +1,287 @@
+import os
+import tempfile
+import threading
+import numpy as np
+from config import db_dir, VECTOR_INDEX_MMAP
+
+# In-process copy of the chunk embeddings for retrieval. Vectors are kept normalized
+# in one contiguous float32 matrix, so top-k is a single matrix-vector product and
+# MMR works on a small candidate matrix instead of Python loops. With VECTOR_INDEX_MMAP
+# the matrix lives in a scratch file under db_dir and is paged in by the OS instead of
+# being held on the heap. Every process maps its own scratch file, unlinked right after
+# it is mapped, so worker processes never share or truncate each other's matrix.
+#
+# The vectors of committed chunks are also stored in the manifest database, written in
+# the same transaction as the manifest. The matrix is loaded from there, and `sync`
+# catches up with chunks another process added or removed, which a Chroma client
+# opened before those writes would not see. Every commit logs the chunk ids it added
+# and removed under its collection version, so catching up reads only the versions
+# since the last sync. The log keeps CHANGE_LOG_VERSIONS versions, a process further
+# behind compares all stored chunk ids instead.
+
+# Prefix of the scratch files
+vector_index_file = os.path.join(db_dir, "vector_index.f32")
+
+CHANGE_LOG_VERSIONS = 1000
+
+
+def create_tables(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS chunk_vectors (chunk_id TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS vector_changes (version INTEGER NOT NULL, chunk_id TEXT NOT NULL, added INTEGER NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vector_changes_version ON vector_changes (version)")
+    # The log holds every change after this version
+    conn.execute(
+        "INSERT OR IGNORE INTO collection_state (name, value) "
+        "SELECT 'vector_changes_since', value FROM collection_state WHERE name = 'version'"
+    )
+
+
+def store_vectors(conn, items):
+    # `items` is a list of (chunk_id, vector) pairs
+    conn.executemany(
+        "INSERT OR REPLACE INTO chunk_vectors (chunk_id, vector) VALUES (?, ?)",
+        [(chunk_id, np.asarray(vector, dtype=np.float32).tobytes()) for chunk_id, vector in items],
+    )
+
+
+def remove_vectors(conn, chunk_ids):
+    conn.executemany("DELETE FROM chunk_vectors WHERE chunk_id = ?", [(chunk_id,) for chunk_id in chunk_ids])
+
+
+def log_changes(conn, version, added, removed):
+    # Called in the transaction that committed `version`
+    conn.executemany(
+        "INSERT INTO vector_changes (version, chunk_id, added) VALUES (?, ?, ?)",
+        [(version, chunk_id, 1) for chunk_id in added] + [(version, chunk_id, 0) for chunk_id in removed],
+    )
+    oldest = version - CHANGE_LOG_VERSIONS
+    conn.execute("DELETE FROM vector_changes WHERE version <= ?", (oldest,))
+    conn.execute(
+        "UPDATE collection_state SET value = MAX(value, ?) WHERE name = 'vector_changes_since'", (oldest,)
+    )
+
+
+def _logged_changes(conn, since_version, version):
+    # Returns (added, removed) chunk ids between the two versions, or None when the log
+    # no longer reaches back to `since_version`
+    row = conn.execute("SELECT value FROM collection_state WHERE name = 'vector_changes_since'").fetchone()
+    if since_version is None or row is None or since_version < row[0]:
+        return None
+    latest = {}
+    rows = conn.execute(
+        "SELECT chunk_id, added FROM vector_changes WHERE version > ? AND version <= ? ORDER BY version, rowid",
+        (since_version, version),
+    )
+    for chunk_id, added in rows:
+        latest[chunk_id] = added
+    return (
+        [chunk_id for chunk_id, added in latest.items() if added],
+        [chunk_id for chunk_id, added in latest.items() if not added],
+    )
+
+
+def backfill(db, conn):
+    # Stores the vectors of chunks indexed by an earlier version, read from Chroma. Runs
+    # once per manifest, flagged in collection_state, since every chunk committed since
+    # has its vector stored in the same transaction. Returns the ids of the stored vectors.
+    if conn.execute("SELECT 1 FROM collection_state WHERE name = 'vectors_backfilled'").fetchone():
+        return []
+    rows = conn.execute(
+        "SELECT chunk_id FROM chunk_text WHERE chunk_id NOT IN (SELECT chunk_id FROM chunk_vectors)"
+    ).fetchall()
+    missing = [chunk_id for (chunk_id,) in rows]
+    if missing:
+        print(f"\nCopying {len(missing)} stored vectors into the manifest database")
+    for start in range(0, len(missing), 500):
+        stored = db._collection.get(ids=missing[start:start + 500], include=["embeddings"])
+        with conn:
+            store_vectors(conn, list(zip(stored["ids"], stored["embeddings"])))
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO collection_state (name, value) VALUES ('vectors_backfilled', 1)")
+    return missing
+
+
+def _read_vectors(conn, chunk_ids=None, page_size=500):
+    # Yields (ids, vectors) pages, of all stored vectors or of `chunk_ids`
+    if chunk_ids is None:
+        cursor = conn.execute("SELECT chunk_id, vector FROM chunk_vectors")
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            yield [chunk_id for chunk_id, _ in rows], [np.frombuffer(vector, dtype=np.float32) for _, vector in rows]
+        return
+    for start in range(0, len(chunk_ids), page_size):
+        batch = chunk_ids[start:start + page_size]
+        rows = conn.execute(
+            f"SELECT chunk_id, vector FROM chunk_vectors WHERE chunk_id IN ({','.join('?' * len(batch))})", batch
+        ).fetchall()
+        if rows:
+            yield [chunk_id for chunk_id, _ in rows], [np.frombuffer(vector, dtype=np.float32) for _, vector in rows]
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    def __init__(self, mmap=VECTOR_INDEX_MMAP, path=vector_index_file):
+        self.mmap = mmap
+        self.path = path
+        self.loaded = False
+        self.dim = None
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._ids = []
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _allocate(self, capacity):
+        if self.mmap:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            fd, scratch_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + "-", suffix=".tmp")
+            try:
+                os.close(fd)
+                matrix = np.memmap(scratch_path, dtype=np.float32, mode="w+", shape=(capacity, self.dim))
+            finally:
+                # The mapping keeps the file's pages until it is dropped
+                os.unlink(scratch_path)
+        else:
+            matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        if self._matrix is not None:
+            matrix[:len(self._ids)] = self._matrix[:len(self._ids)]
+        self._matrix = matrix
+
+    def _ensure_capacity(self, rows):
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+        if rows > capacity:
+            self._allocate(max(1024, capacity * 2, rows))
+
+    def load(self, conn):
+        # Reads every stored vector from the manifest database
+        with self._lock:
+            self._matrix, self._ids, self._rows, self.dim = None, [], {}, None
+            for ids, vectors in _read_vectors(conn):
+                self._add(ids, vectors)
+            self.loaded = True
+        print(f"Loaded {len(self._ids)} vectors into the retrieval index")
+
+    def sync(self, conn, since_version=None, version=None):
+        # Adds and removes rows so the index matches the stored vectors of `version`
+        # again, after reflecting `since_version`
+        changes = _logged_changes(conn, since_version, version)
+        if changes is not None:
+            added, removed = changes
+        else:
+            stored = {chunk_id for (chunk_id,) in conn.execute("SELECT chunk_id FROM chunk_vectors")}
+            with self._lock:
+                removed = [chunk_id for chunk_id in self._rows if chunk_id not in stored]
+                added = [chunk_id for chunk_id in stored if chunk_id not in self._rows]
+        self.remove(removed)
+        for ids, vectors in _read_vectors(conn, added):
+            self.add(ids, vectors)
+        return len(added), len(removed)
+
+    def _add(self, ids, vectors):
+        vectors = _normalize(vectors)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        new_ids = [chunk_id for chunk_id in ids if chunk_id not in self._rows]
+        self._ensure_capacity(len(self._ids) + len(new_ids))
+        for chunk_id, vector in zip(ids, vectors):
+            row = self._rows.get(chunk_id)
+            if row is None:
+                row = self._rows[chunk_id] = len(self._ids)
+                self._ids.append(chunk_id)
+            self._matrix[row] = vector
+
+    def add(self, ids, vectors):
+        # Updates before `load` are ignored, the load picks them up from the database
+        if not ids or not self.loaded:
+            return
+        with self._lock:
+            self._add(ids, vectors)
+
+    def remove(self, ids):
+        # The last row is moved into each freed row, keeping the matrix contiguous
+        if not self.loaded:
+            return
+        with self._lock:
+            for chunk_id in ids:
+                row = self._rows.pop(chunk_id, None)
+                if row is None:
+                    continue
+                last_id = self._ids.pop()
+                if last_id != chunk_id:
+                    self._matrix[row] = self._matrix[len(self._ids)]
+                    self._ids[row] = last_id
+                    self._rows[last_id] = row
+
+    def _candidates(self, query, limit, restrict_ids):
+        # Returns (rows, similarities) of the `limit` most similar vectors, best first
+        if restrict_ids is None:
+            rows = None
+            similarities = self._matrix[:len(self._ids)] @ query
+        else:
+            rows = np.fromiter(
+                (self._rows[chunk_id] for chunk_id in restrict_ids if chunk_id in self._rows), dtype=np.int64
+            )
+            similarities = self._matrix[rows] @ query
+        limit = min(limit, len(similarities))
+        if limit == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = np.argpartition(-similarities, limit - 1)[:limit]
+        top = top[np.argsort(-similarities[top])]
+        return (top if rows is None else rows[top]), similarities[top]
+
+    def search(self, vector, k, restrict_ids=None):
+        # Returns [(chunk_id, cosine similarity)], most similar first. `restrict_ids`
+        # limits the search to the given chunks, e.g. those of some source files.
+        query = _normalize(vector)
+        with self._lock:
+            if not self._ids:
+                return []
+            rows, similarities = self._candidates(query, k, restrict_ids)
+            return [(self._ids[row], float(similarity)) for row, similarity in zip(rows, similarities)]
+
+    def similarities(self, vector, ids):
+        # Returns {chunk_id: cosine similarity} for those of the given chunks in the index
+        query = _normalize(vector)
+        with self._lock:
+            known = [chunk_id for chunk_id in dict.fromkeys(ids) if chunk_id in self._rows]
+            if not known:
+                return {}
+            rows = np.fromiter((self._rows[chunk_id] for chunk_id in known), dtype=np.int64, count=len(known))
+            return dict(zip(known, (self._matrix[rows] @ query).tolist()))
+
+    def max_marginal_relevance(self, vector, k, fetch_k=30, lambda_mult=0.5, restrict_ids=None):
+        # Same selection as Chroma's MMR: each step picks the candidate maximizing
+        # lambda * similarity to the query - (1 - lambda) * max similarity to the picks
+        query = _normalize(vector)
+        with self._lock:
+            if not self._ids:
+                return []
+            rows, query_similarities = self._candidates(query, fetch_k, restrict_ids)
+            candidates = self._matrix[rows]
+            ids = [self._ids[row] for row in rows]
+        pairwise = candidates @ candidates.T
+        redundancy = np.full(len(ids), -np.inf, dtype=np.float32)
+        available = np.ones(len(ids), dtype=bool)
+        selected = []
+        for _ in range(min(k, len(ids))):
+            penalty = redundancy if selected else 0.0
+            scores = lambda_mult * query_similarities - (1 - lambda_mult) * penalty
+            scores[~available] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            available[best] = False
+            redundancy = np.maximum(redundancy, pairwise[best])
+        # Like Chroma, return the picks in order of similarity to the query
+        return [ids[index] for index in sorted(selected)]